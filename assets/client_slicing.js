@@ -0,0 +1,123 @@
+// Client-side slicing (the "Slice in browser" option). The selected data is
+// sent once to the 'client-matrix' store as base64 float32 arrays. A band
+// drawn on the heatmap is averaged here and its trace appended to the
+// kinetics or spectra graph, with no round trip to the server; the slice is
+// then handed to the server through the 'client-slice' store. The callbacks
+// are set up in strankslab-data-analysis.py.
+(function () {
+    var decoded = {};
+
+    function decode(packed) {
+        var bytes = atob(packed.bdata);
+        var buffer = new ArrayBuffer(bytes.length);
+        var view = new Uint8Array(buffer);
+        for (var i = 0; i < bytes.length; i++) {
+            view[i] = bytes.charCodeAt(i);
+        }
+        return new Float32Array(buffer);
+    }
+
+    // Decoded arrays of the store, kept until a new matrix arrives
+    function matrix(store) {
+        if (decoded.bdata !== store.dtt.bdata) {
+            decoded = {bdata: store.dtt.bdata, time: decode(store.time),
+                       wavelength: decode(store.wavelength), dtt: decode(store.dtt)};
+        }
+        return decoded;
+    }
+
+    // Index of the value closest to x on an ascending axis
+    function closest(axis, x) {
+        var lo = 0;
+        var hi = axis.length - 1;
+        while (hi - lo > 1) {
+            var mid = (lo + hi) >> 1;
+            if (axis[mid] < x) {
+                lo = mid;
+            } else {
+                hi = mid;
+            }
+        }
+        return Math.abs(axis[hi] - x) < Math.abs(axis[lo] - x) ? hi : lo;
+    }
+
+    // Mean of dtt over rows first..last (axis 0, giving a spectrum) or
+    // columns first..last (axis 1, giving a kinetic), NaN cells ignored,
+    // like band_average on the server
+    function bandAverage(m, axis, first, last) {
+        var rows = m.time.length;
+        var cols = m.wavelength.length;
+        var n = axis === 0 ? cols : rows;
+        var total = new Float64Array(n);
+        var count = new Float64Array(n);
+        var r0 = axis === 0 ? first : 0;
+        var r1 = axis === 0 ? last : rows - 1;
+        var c0 = axis === 0 ? 0 : first;
+        var c1 = axis === 0 ? cols - 1 : last;
+        for (var r = r0; r <= r1; r++) {
+            for (var c = c0; c <= c1; c++) {
+                var v = m.dtt[r * cols + c];
+                if (!isNaN(v)) {
+                    var k = axis === 0 ? c : r;
+                    total[k] += v;
+                    count[k] += 1;
+                }
+            }
+        }
+        var result = new Array(n);
+        for (var i = 0; i < n; i++) {
+            result[i] = count[i] ? total[i] / count[i] : null;
+        }
+        return result;
+    }
+
+    window.dash_clientside = window.dash_clientside || {};
+    window.dash_clientside.slicing = {
+        // Outputs the kinetics figure, shown keys and dropdown, the same for
+        // the spectra, and the new slice for the server
+        add_slice: function (relayout, enabled, store, timeSwitch,
+                             kinFigure, kinShown, wvlOptions, wvlValue,
+                             specFigure, specShown, timeOptions, timeValue) {
+            var clientside = window.dash_clientside;
+            if (!enabled || !store || !relayout || !relayout.shapes
+                    || !relayout.shapes.length) {
+                throw clientside.PreventUpdate;
+            }
+            var shape = relayout.shapes[relayout.shapes.length - 1];
+            var axis = timeSwitch ? 0 : 1;
+            var lo = Math.min(timeSwitch ? shape.x0 : shape.y0, timeSwitch ? shape.x1 : shape.y1);
+            var hi = Math.max(timeSwitch ? shape.x0 : shape.y0, timeSwitch ? shape.x1 : shape.y1);
+            var unit = timeSwitch ? ' ' + store.timescale : ' nm';
+            var key = Math.round(lo) + unit + ' - ' + Math.round(hi) + unit;
+
+            var figure = timeSwitch ? specFigure : kinFigure;
+            var shown = timeSwitch ? specShown : kinShown;
+            var options = (timeSwitch ? timeOptions : wvlOptions) || [];
+            var value = (timeSwitch ? timeValue : wvlValue) || [];
+            var newFigure = clientside.no_update;
+            var newShown = clientside.no_update;
+            // Only a graph already showing this data is extended; otherwise
+            // the dropdown change makes the server draw it
+            if (figure && shown && shown.file === store.file) {
+                var m = matrix(store);
+                var values = timeSwitch ? m.time : m.wavelength;
+                var first = closest(values, lo);
+                var last = closest(values, hi);
+                var color = store.colors[shown.keys.length % store.colors.length];
+                newFigure = Object.assign({}, figure, {data: figure.data.concat([{
+                    type: 'scatter', mode: 'lines', name: key,
+                    x: Array.from(timeSwitch ? m.wavelength : m.time),
+                    y: bandAverage(m, axis, Math.min(first, last), Math.max(first, last)),
+                    line: {color: color}
+                }])});
+                newShown = {file: shown.file, keys: shown.keys.concat([key])};
+            }
+            var slice = [newFigure, newShown, options.concat([key]), value.concat([key])];
+            var none = [clientside.no_update, clientside.no_update,
+                        clientside.no_update, clientside.no_update];
+            var outputs = timeSwitch ? none.concat(slice) : slice.concat(none);
+            return outputs.concat([{kind: timeSwitch ? 'time' : 'wvl', key: key,
+                                    bounds: [lo, hi]}]);
+        }
+    };
+})();
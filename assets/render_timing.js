@@ -0,0 +1,28 @@
+// Reports how long plotly.js took to draw the TA heatmap after the figure
+// arrived. The start time is set by the clientside callback on ta-graph's
+// figure in strankslab-data-analysis.py.
+(function () {
+    function attach(graph) {
+        var plot = graph.querySelector('.js-plotly-plot');
+        if (!plot || plot._renderTimingAttached || !plot.on) {
+            return;
+        }
+        plot._renderTimingAttached = true;
+        plot.on('plotly_afterplot', function () {
+            var start = window.dash_clientside.renderStart;
+            var readout = document.getElementById('ta-render');
+            if (start === undefined || !readout) {
+                return;
+            }
+            readout.textContent = 'drawn in ' + Math.round(performance.now() - start) + ' ms';
+            window.dash_clientside.renderStart = undefined;
+        });
+    }
+
+    new MutationObserver(function () {
+        var graph = document.getElementById('ta-graph');
+        if (graph) {
+            attach(graph);
+        }
+    }).observe(document.documentElement, {childList: true, subtree: true});
+})();
@@ -0,0 +1,62 @@
+// Streams files picked with the "Add file" button, or dropped on it, to the
+// /upload endpoint as raw request bodies. Nothing is base64-encoded or passed
+// through a Dash callback; once every file is spooled on the server the list
+// of {path, name, sha256} records is handed to Dash through the 'file-load'
+// store, which triggers the import.
+(function () {
+    function uploadFile(file) {
+        return fetch('upload?name=' + encodeURIComponent(file.name), {
+            method: 'POST',
+            headers: {'Content-Type': 'application/octet-stream'},
+            body: file
+        }).then(function (response) {
+            return response.json().then(function (result) {
+                if (!response.ok) {
+                    throw new Error(result.error || response.statusText);
+                }
+                return result;
+            });
+        });
+    }
+
+    function uploadFiles(files) {
+        if (!files || !files.length) {
+            return;
+        }
+        Promise.all(Array.prototype.map.call(files, uploadFile))
+            .then(function (results) {
+                window.dash_clientside.set_props('file-load', {
+                    data: {files: results, time: Date.now()}
+                });
+            })
+            .catch(function (error) {
+                window.alert('Upload failed: ' + error.message);
+            });
+    }
+
+    document.addEventListener('click', function (event) {
+        if (event.target.closest('#file-load-button')) {
+            var input = document.createElement('input');
+            input.type = 'file';
+            input.multiple = true;
+            input.accept = '.h5,.hdf5';
+            input.addEventListener('change', function () {
+                uploadFiles(input.files);
+            });
+            input.click();
+        }
+    });
+
+    document.addEventListener('dragover', function (event) {
+        if (event.target.closest('#file-drop')) {
+            event.preventDefault();
+        }
+    });
+
+    document.addEventListener('drop', function (event) {
+        if (event.target.closest('#file-drop')) {
+            event.preventDefault();
+            uploadFiles(event.dataTransfer.files);
+        }
+    });
+})();
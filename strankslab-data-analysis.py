@@ -1,24 +1,243 @@
+import time as timer
+#Start of the import, for the startup time reported by the server
+IMPORT_STARTED = timer.perf_counter()
 import dash
 import dash_bootstrap_components as dbc
-from dash import dcc, Input, Output, State, html, no_update
+from dash import dcc, Input, Output, State, html, no_update, ClientsideFunction
 from dash.exceptions import PreventUpdate
-import plotly.express as px
+from prometheus_client import (Counter, Gauge, Histogram, CollectorRegistry,
+                               generate_latest, multiprocess, CONTENT_TYPE_LATEST)
+import flask
+from werkzeug.utils import secure_filename
 import plotly.graph_objects as go
+import plotly.colors
+from plotly.utils import PlotlyJSONEncoder
 import numpy as np
-import pandas as pd
 import h5py
 import math
-from bisect import bisect_left
+import os
+import re
+import sys
+import glob
+import argparse
+import zlib
+import base64
+import struct
+import json
+import uuid
+import hashlib
+import tempfile
+import shutil
+import traceback
+import warnings
+import io
+import zipfile
+from urllib.parse import urlencode
+import threading
+import functools
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import OrderedDict
+from itertools import repeat
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-app = dash.Dash(external_stylesheets=[dbc.themes.FLATLY])
+app = dash.Dash(__name__, external_stylesheets=[dbc.themes.FLATLY],
+                assets_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           'assets'))
 
-#Data storage variables
-DATA = pd.DataFrame(index = ['wavelength', 'time', 'dtt', 'timescale'])
-TIME_SLICES = pd.DataFrame()
-WVL_SLICES = pd.DataFrame()
+#Data storage variables. Loaded files live in DATA, a DatasetRegistry created
+#below its class definition, which keeps at most DATA_MEMORY_BUDGET bytes of
+#arrays in memory and evicts the least recently used files back to disk. It
+#also holds at most DATA_MAX_RECORDS records (files, preprocessed views, scan
+#counts of live files, overlays), as shared arrays are memory-mapped and
+#don't count towards the budget; the least recently used are dropped and
+#their files closed.
+DATA_MEMORY_BUDGET = 2 * 2**30
+DATA_MAX_RECORDS = 64
+
+#Directory shared by every worker process on this machine. It holds the
+#per-session state (slice definitions, keyed by the session-id store in each
+#browser tab) and memory-mappable copies of the large arrays, so all workers
+#map the same pages instead of each reading its own copy of every file. It is
+#kept in the user's cache directory rather than under /tmp, which may be held
+#in memory and is cleared on reboot.
+SHARED_DIR = os.environ.get('STRANKSLAB_SHARED_DIR', os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'strankslab'))
+
+#Per-session state is kept in SESSION_DIR and deleted once a session has been
+#left untouched for SESSION_MAX_AGE seconds
+SESSION_DIR = os.path.join(SHARED_DIR, 'sessions')
+SESSION_MAX_AGE = 7 * 24 * 3600
+
+#Persistent array cache. Everything derived from a file (its axes, dtt,
+#prefix sums, heatmap pyramid, decompositions, fits, preprocessing stages) is
+#saved under CACHE_DIR/<key>, where the key is the SHA-256 of the file's
+#contents, so it survives restarts and re-uploads. CACHE_INDEX_DIR remembers
+#the hash of each path by size and modification time: an unchanged file is
+#never re-hashed and a changed one gets a new key. Once the cache and the
+#spooled uploads hold more than CACHE_MAX_BYTES the least recently opened keys
+#are deleted, with their uploads.
+CACHE_DIR = os.path.join(SHARED_DIR, 'arrays')
+CACHE_INDEX_DIR = os.path.join(SHARED_DIR, 'index')
+CACHE_MAX_BYTES = int(os.environ.get('STRANKSLAB_CACHE_BYTES', 20 * 2**30))
+
+#Files added in the browser are streamed to the /upload endpoint (see
+#assets/upload.js) and written to SPOOL_DIR in UPLOAD_CHUNK_BYTES pieces under
+#their SHA-256, so a file uploaded twice is only stored once
+SPOOL_DIR = os.path.join(SHARED_DIR, 'uploads')
+UPLOAD_CHUNK_BYTES = 4 * 2**20
+
+#Importing a file (reading dtt, building prefix sums and the heatmap pyramid)
+#runs as a background job on a pool of JOB_WORKERS processes. Each job writes
+#its progress to a small JSON file in JOB_DIR, which the sidebar polls every
+#JOB_POLL_MS milliseconds.
+JOB_WORKERS = os.cpu_count() or 1
+JOB_DIR = os.path.join(SHARED_DIR, 'jobs')
+JOB_POLL_MS = 500
+JOB_POOL = None
+
+#Watch mode. If STRANKSLAB_WATCH_DIR is set, every open tab checks the
+#directory every WATCH_POLL_MS milliseconds and adds new .hdf5 files to the
+#file list. Files holding a 3-D 'Scans' dataset are treated as still being
+#acquired: they are opened in SWMR (single writer, multiple readers) mode, only
+#the scans appended since the last check are read, and the running average and
+#open views are updated. The newest scan counts once the next one has started
+#or the file has been left alone for WATCH_SETTLE_SECONDS.
+WATCH_DIR = os.environ.get('STRANKSLAB_WATCH_DIR')
+WATCH_POLL_MS = 2000
+WATCH_SETTLE_SECONDS = 5
+
+#Production server (the 'serve' subcommand): gunicorn at SERVE_BIND with
+#SERVE_WORKERS pre-forked worker processes, one per core by default. The app,
+#and any files listed in STRANKSLAB_PRELOAD (separated like PATH), are loaded
+#once before forking, so the workers share those pages copy-on-write and take
+#requests as soon as they are forked. Workers silent for SERVE_TIMEOUT seconds
+#(longer than any fit or import) are restarted.
+SERVE_BIND = os.environ.get('STRANKSLAB_BIND', '0.0.0.0:8888')
+SERVE_WORKERS = int(os.environ.get('STRANKSLAB_WORKERS', os.cpu_count() or 1))
+SERVE_TIMEOUT = 300
+PRELOAD_FILES = [path for path in os.environ.get('STRANKSLAB_PRELOAD', '').split(os.pathsep) if path]
+
+#Heatmap decimation settings. The heatmap sent to the browser never holds
+#more than HEATMAP_MAX_POINTS (delay points, wavelength points), roughly the
+#pixel count of a screen. Each pyramid level is PYRAMID_FACTOR times coarser
+#along every axis that is still too large, and HEATMAP_REDUCTION picks what a
+#decimated cell shows: 'extrema' keeps the block min or max (whichever lies
+#further from the block mean) so narrow features survive, 'mean' shows the
+#plain block mean.
+HEATMAP_MAX_POINTS = (1920, 1080)
+PYRAMID_FACTOR = 4
+HEATMAP_REDUCTION = 'extrema'
+HEATMAP_MARGIN = 0.25
+PYRAMID_BLOCK_BYTES = 64 * 2**20
+
+#How the heatmap is sent to the browser (switchable in the Options section):
+#'json' is plotly's default nested list of floats, 'binary' packs x/y/z as
+#base64 typed arrays, 'image' sends a colour-mapped PNG rendered on the server
+#plus a transparent low resolution heatmap (at most HOVER_MAX_POINTS) that
+#keeps hover values and the colour bar working
+HEATMAP_TRANSPORT = 'binary'
+HOVER_MAX_POINTS = (480, 270)
+
+#Slicing in the browser (switchable in the Options section). When on, the
+#selected data is sent once to the client-matrix store as float32 typed
+#arrays, from the finest pyramid level with at most CLIENT_MAX_CELLS cells,
+#and bands drawn on the heatmap are averaged by assets/client_slicing.js, so
+#the kinetics or spectra graph updates without a round trip to the server
+CLIENT_SLICING = False
+CLIENT_MAX_CELLS = 2**21
+
+#Global analysis settings. The leading SVD_RANK singular values and vectors
+#of a file's dtt are found by randomized SVD with SVD_OVERSAMPLES extra random
+#vectors and SVD_POWER_ITERATIONS power iterations, and saved per file as
+#shared arrays. SVD_SHOWN components are plotted by default.
+SVD_RANK = 20
+SVD_OVERSAMPLES = 10
+SVD_POWER_ITERATIONS = 2
+SVD_SHOWN = 3
+
+#Delay types written by the acquisition software and the delay unit of each
+#(matched ignoring case). A file can also give its unit directly in a 'delay
+#unit' attribute on 'Average' or the scans; otherwise fs is assumed.
+DELAY_TYPES = {'short': 'fs', 'long': 'ps', 'ultralong': 'ns', 'nanosecond': 'ns',
+               'microsecond': 'µs', 'millisecond': 'ms', 'fs': 'fs', 'ps': 'ps',
+               'ns': 'ns', 'us': 'µs', 'µs': 'µs', 'ms': 'ms', 's': 's'}
+
+#Per-scan averaging. Files may hold their individual scans besides 'Average',
+#either as a 3-D 'Scans' dataset (scan x delay x wavelength, each frame laid
+#out like 'Average') or as 2-D datasets named 'Scan <n>', optionally in a
+#'Scans' group. Scans are streamed SCAN_BLOCK_BYTES at a time (a block of
+#delay rows from every scan). Points more than SCAN_CLIP_SIGMA robust standard
+#deviations from the median of the scans are left out of the clipped average;
+#scans whose deviation from the median is more than SCAN_OUTLIER_SIGMA robust
+#standard deviations, and at least SCAN_OUTLIER_EXCESS (a fraction), above that
+#of a typical scan are flagged as outliers.
+SCAN_BLOCK_BYTES = 64 * 2**20
+SCAN_CLIP_SIGMA = 3.0
+SCAN_OUTLIER_SIGMA = 3.5
+SCAN_OUTLIER_EXCESS = 0.2
+
+#Photoluminescence data. Besides TA data ('Average' and scans) a file may hold
+#a 'PL Map' (laid out like 'Average', delay in column 0), a 'PL Spectrum'
+#(columns: wavelength, then one or more steady-state spectra) or time-tagged
+#TCSPC photons: a 'Photons' group with a per-photon 'dtime' (arrival after the
+#sync pulse, in ticks of the group's 'resolution' attribute in seconds) and
+#optionally 'channel' (detector channel, indexing the group's 'wavelength'
+#dataset). Photons are read PHOTON_CHUNK records at a time and histogrammed
+#into TCSPC_BIN_SECONDS wide delay bins, so files larger than memory load.
+PHOTON_CHUNK = 2**22
+TCSPC_BIN_SECONDS = 16e-12
+
+#Quantity shown for each kind of file
+QUANTITIES = {'ta': '\u0394T/T', 'pl-map': 'PL', 'pl-spectrum': 'PL', 'tcspc': 'Counts'}
+
+#Preprocessing pipeline. Files are read raw; the stages set in the sidebar
+#(background subtraction, chirp correction, bad-pixel masking, smoothing,
+#delay rebinning) run in PIPELINE_STAGES order over dtt and every view reads
+#the last stage's output. Each stage's output is saved as a shared array
+#keyed by a hash of its input and parameters, so changing one stage
+#recomputes only it and those after it. PIPELINE_DIR holds the stage
+#settings behind each selection.
+PIPELINE_DIR = os.path.join(SHARED_DIR, 'pipelines')
+
+#Kinetic fitting settings. A fit stops after FIT_MAX_ITERATIONS
+#Levenberg-Marquardt steps. Per-wavelength fits are split into chunks of
+#FIT_CHUNK_COLUMNS wavelengths that run in parallel on the job pool.
+FIT_MAX_ITERATIONS = 50
+FIT_CHUNK_COLUMNS = 64
+
+#Exports. /export streams the map (dtt), kinetics or spectra of one or more
+#selections as CSV, gzip-compressed HDF5 or, if pyarrow is installed,
+#Parquet. Maps are read and written EXPORT_BLOCK_BYTES of rows at a time, and
+#HDF5/Parquet files are spooled to disk before they are streamed out.
+EXPORT_BLOCK_BYTES = 16 * 2**20
+EXPORT_FORMATS = OrderedDict([('csv', ('CSV', 'text/csv', '.csv')),
+                              ('hdf5', ('HDF5', 'application/x-hdf5', '.hdf5')),
+                              ('parquet', ('Parquet', 'application/vnd.apache.parquet', '.parquet'))])
+
+#Line styles telling overlaid files apart on the kinetics and spectra graphs;
+#each slice keeps its colour in every file
+OVERLAY_DASHES = ['dash', 'dot', 'dashdot', 'longdash', 'longdashdot']
+
+#Instrumentation. Every callback and the loading and slicing helpers are timed
+#and exported with the response sizes and loaded memory in Prometheus format
+#at /metrics. With several worker processes, set PROMETHEUS_MULTIPROC_DIR so
+#the endpoint reports all of them. With STRANKSLAB_LOG_TIMINGS=1 each
+#callback's timing breakdown is also printed.
+LOG_TIMINGS = os.environ.get('STRANKSLAB_LOG_TIMINGS', '') not in ('', '0')
 
 #Used for styling Plotly graphs
-standard_template = dict(layout=go.Layout(
+standard_template = dict(layout=dict(
     font = dict(family="Arial", size=12, color='black'), 
     paper_bgcolor = '#ffffff', 
     plot_bgcolor = '#ffffff', 
@@ -32,10 +251,12 @@ standard_template = dict(layout=go.Layout(
                )
     ))
     
-#Placeholder figure before plotting data
-blank_fig = px.scatter(pd.DataFrame(), template=standard_template)
-blank_fig.update_xaxes(title_text = '', zeroline=False)
-blank_fig.update_yaxes(title_text='', zeroline=False)
+#Placeholder figure before plotting data. Kept as a plain dict (as is the
+#template), so no figure objects are built until the first graph is drawn.
+blank_fig = dict(data=[], layout=dict(
+    template=standard_template, legend=dict(tracegroupgap=0), margin=dict(t=60),
+    xaxis=dict(title=dict(text=''), zeroline=False),
+    yaxis=dict(title=dict(text=''), zeroline=False)))
 
 #Interactive Dash components
 nav_dropdown = dbc.DropdownMenu(
@@ -52,14 +273,20 @@ nav_dropdown = dbc.DropdownMenu(
 
 file_dropdown = dcc.Dropdown(id='file-dropdown', options={})
 
-upload = dcc.Upload(id='file-load', 
-                    children = dbc.Button("Add file", 
-                                          id="file-load-button", 
-                                          n_clicks=0, 
-                                          color="primary", 
-                                          size='sm'
-                                          )
-                    )
+# Other files whose slices are overlaid on the kinetics and spectra
+overlay_dropdown = dcc.Dropdown(id='overlay-files', options={}, value=[], multi=True,
+                                placeholder='Compare with...')
+
+# Files picked with the button or dropped on it are streamed to /upload by
+# assets/upload.js, which reports the spooled files in the 'file-load' store
+upload = html.Div([
+    dbc.Button("Add file", 
+               id="file-load-button", 
+               n_clicks=0, 
+               color="primary", 
+               size='sm'),
+    dcc.Store(id='file-load')],
+    id='file-drop')
 delete = dbc.Button("Delete", id="file-delete", n_clicks=0,
                     color="danger", size='sm')
 
@@ -97,6 +324,104 @@ wvl_input = dbc.InputGroup([
                size='sm', color="danger")
     ])
 
+# Preprocessing stages; a stage runs when its inputs are filled in. For files
+# holding their individual scans, the average can be recomputed from them.
+pipeline_input = html.Div([
+    dbc.RadioItems(
+        options=[
+            {"label": "File average", "value": 'file'},
+            {"label": "Scan mean", "value": 'mean'},
+            {"label": "Clipped mean", "value": 'clipped'},
+            {"label": "Std. error", "value": 'stderr'},
+            ],
+            value='file',
+            id='scan-average',
+            inline=True),
+    dbc.Checkbox(id='scan-drop-outliers', label='Drop outlier scans', value=False),
+    dbc.InputGroup([
+        dbc.InputGroupText('Background before', style={'fontSize': 'small'}),
+        dbc.Input(id='background-before', type='number', size='sm',
+                  placeholder='Delay', debounce=True)]),
+    dbc.InputGroup([
+        dbc.InputGroupText('Chirp t0', style={'fontSize': 'small'}),
+        dbc.Input(id='chirp-coefficients', type='text', size='sm',
+                  placeholder='c0, c1, c2', debounce=True),
+        dbc.Input(id='chirp-reference', type='number', size='sm',
+                  placeholder='Ref. (nm)', debounce=True)]),
+    dbc.InputGroup([
+        dbc.InputGroupText('Bad pixels', style={'fontSize': 'small'}),
+        dbc.Input(id='mask-threshold', type='number', size='sm',
+                  placeholder='Noise MADs', debounce=True),
+        dbc.Input(id='mask-bands', type='text', size='sm',
+                  placeholder='e.g. 530-535', debounce=True)]),
+    dbc.InputGroup([
+        dbc.InputGroupText('Smooth', style={'fontSize': 'small'}),
+        dbc.Input(id='smooth-time', type='number', min=1, step=1, size='sm',
+                  placeholder='Delay pts', debounce=True),
+        dbc.Input(id='smooth-wvl', type='number', min=1, step=1, size='sm',
+                  placeholder='Wvl pts', debounce=True)]),
+    dbc.InputGroup([
+        dbc.InputGroupText('Rebin delays', style={'fontSize': 'small'}),
+        dbc.Select(id='rebin-mode', size='sm', value='none', options=[
+            {'label': 'No', 'value': 'none'},
+            {'label': 'Linear', 'value': 'linear'},
+            {'label': 'Log', 'value': 'log'},
+            {'label': 'Lin-log', 'value': 'linlog'}]),
+        dbc.Input(id='rebin-points', type='number', min=2, step=1, size='sm',
+                  placeholder='Points', debounce=True),
+        dbc.Input(id='rebin-linear', type='number', min=0, size='sm',
+                  placeholder='Lin. until', debounce=True)]),
+    html.Small(id='pipeline-status', className='text-muted')])
+
+svd_input = html.Div([
+    dbc.InputGroup([
+        dbc.InputGroupText('Components', style={'fontSize': 'small'}),
+        dbc.Input(id='svd-components', type='number', min=1, step=1,
+                  value=SVD_SHOWN, size='sm'),
+        dbc.Button('Run SVD', id='svd-run', n_clicks=0,
+                   size='sm', color='primary')]),
+    html.Small(id='svd-status', className='text-muted')])
+
+fit_input = html.Div([
+    dbc.InputGroup([
+        dbc.Input(id='fit-lifetimes', type='text', size='sm',
+                  placeholder='Lifetimes, e.g. 1, 10, 100'),
+        dbc.Input(id='fit-irf', type='number', size='sm', placeholder='IRF FWHM'),
+        dbc.Input(id='fit-t0', type='number', size='sm', placeholder='t0', value=0)]),
+    dbc.RadioItems(
+        options=[
+            {"label": "Global", "value": 'global'},
+            {"label": "Per wavelength", "value": 'local'},
+            ],
+            value='global',
+            id='fit-mode',
+            inline=True),
+    dbc.RadioItems(
+        options=[
+            {"label": "All wavelengths", "value": 'columns'},
+            {"label": "Selected slices", "value": 'slices'},
+            ],
+            value='columns',
+            id='fit-target',
+            inline=True),
+    dbc.Button('Fit', id='fit-run', n_clicks=0, size='sm', color='primary'),
+    dbc.Button('Export', id='fit-export', n_clicks=0, size='sm', color='secondary'),
+    dcc.Download(id='fit-download'),
+    html.Div(html.Small(id='fit-status', className='text-muted'))])
+
+# Download link for /export, kept up to date with the selection by a callback
+export_input = html.Div([
+    dbc.InputGroup([
+        dbc.Select(id='export-what', size='sm', value='map', options=[
+            {'label': 'Map', 'value': 'map'},
+            {'label': 'Kinetics', 'value': 'kinetics'},
+            {'label': 'Spectra', 'value': 'spectra'}]),
+        dbc.Select(id='export-format', size='sm', value='csv', options=[
+            {'label': label, 'value': fmt} for fmt, (label, mimetype, ext)
+            in EXPORT_FORMATS.items() if fmt != 'parquet' or pa is not None]),
+        html.A('Download', id='export-link', className='btn btn-secondary btn-sm')]),
+    dbc.Checkbox(id='export-overlays', label='Include compared files', value=False)])
+
 x_axis_options = html.Div([
     html.Div('X-Axis:  ', style={'width': '100px', 'display': 'inline-block'}),
     html.Div([dbc.RadioItems(
@@ -116,6 +441,23 @@ x_axis_options = html.Div([
     ])
 
 
+transport_options = html.Div([
+    html.Div('Heatmap:  ', style={'width': '100px', 'display': 'inline-block'}),
+    html.Div([dbc.RadioItems(
+        options=[
+            {"label": "JSON", "value": 'json'},
+            {"label": "Binary", "value": 'binary'},
+            {"label": "Image", "value": 'image'},
+            ],
+            value=HEATMAP_TRANSPORT,
+            id="transport-type",
+            inline=True,
+            )], style={'display': 'inline-block'}),
+    ])
+
+slicing_options = html.Div([
+    dbc.Switch(id='client-slicing', label='Slice in browser', value=CLIENT_SLICING)])
+
 y_axis_options = html.Div([
     html.Div('Y-Axis:  ', style={'width': '100px', 'display': 'inline-block'}),
     html.Div([dbc.RadioItems(
@@ -147,7 +489,14 @@ hidden_triggers = html.Div([
     html.Div(id='time-from-clear', n_clicks=0),
     html.Div(id='wvl-from-graph', n_clicks=0),
     html.Div(id='wvl-from-input', n_clicks=0),
-    html.Div(id='wvl-from-clear', n_clicks=0)],
+    html.Div(id='wvl-from-clear', n_clicks=0),
+    dcc.Store(id='ta-view', data={}),
+    dcc.Store(id='kin-shown', data={}),
+    dcc.Store(id='spec-shown', data={}),
+    dcc.Store(id='fit-result', data={}),
+    dcc.Store(id='data-selection'),
+    dcc.Store(id='client-matrix'),
+    dcc.Store(id='client-slice')],
     style={'display': 'none'})
 
 
@@ -160,10 +509,24 @@ sidebar = dbc.Col([
         html.Div(upload, style={'display': 'inline-block'}),
         html.Div(delete, style={'display': 'inline-block'})]),
     file_dropdown,
+    overlay_dropdown,
+    html.Div([
+        dbc.Progress(id='job-progress', value=0, striped=True, animated=True,
+                     style={'height': '6px'}),
+        html.Small(id='job-status', className='text-muted')],
+        id='job-display', style={'display': 'none'}),
+    dcc.Store(id='pending-jobs', data=[]),
+    dcc.Interval(id='job-poll', interval=JOB_POLL_MS, disabled=True),
+    dcc.Store(id='live-scans', data={}),
+    dcc.Interval(id='watch-poll', interval=WATCH_POLL_MS, disabled=WATCH_DIR == None),
     html.Div([
         html.H5("Processing"),
         html.Hr(),
         ]),
+    html.Div([
+        html.Div('Preprocessing:'),
+        pipeline_input,
+        html.Br()]),
     html.Div([
         html.Div(time_switch, style={'display': 'inline-block'}),
         time_input,
@@ -172,19 +535,38 @@ sidebar = dbc.Col([
     html.Div([
         html.Div(wvl_switch, style={'display': 'inline-block'}),
         wvl_input,
-        wvl_dropdown]),
+        wvl_dropdown,
+        html.Br()]),
+    html.Div([
+        html.Div('Global analysis (SVD):'),
+        svd_input,
+        html.Br()]),
+    html.Div([
+        html.Div('Kinetic fit:'),
+        fit_input,
+        html.Br()]),
+    html.Div([
+        html.Div('Export:'),
+        export_input]),
     html.Div([
         html.H5('Options'),
         html.Hr(),
         x_axis_options,
-        y_axis_options])
+        y_axis_options,
+        transport_options,
+        slicing_options])
     ],width=3, style={'height': '80vh', 'borderWidth': '4px',
                       'borderStyle': 'solid', 'borderColor': '#a3c1ad', 
                       'overflow': 'scroll'})
 
 
+# ta-payload shows the size and build time of the last heatmap sent;
+# assets/render_timing.js fills ta-render with the browser's drawing time
 main_graph = dbc.Col([dcc.Graph(id='ta-graph', 
-                                figure=blank_fig, style={'height': '80vh'})
+                                figure=blank_fig, style={'height': '80vh'}),
+                      html.Small(id='ta-payload', className='text-muted'),
+                      html.Small(id='ta-render', className='text-muted ms-2'),
+                      dcc.Store(id='ta-render-start')
                       ], width=True)
 
 spec_graph = dcc.Graph(id='spec-graph', figure=blank_fig, 
@@ -192,73 +574,1913 @@ spec_graph = dcc.Graph(id='spec-graph', figure=blank_fig,
 
 kin_graph = dcc.Graph(id='kin-graph', figure=blank_fig, 
                       style={'height': '80vh'})
+
+# Leading SVD components, below the spectra and kinetics they correspond to
+svd_spec_graph = dcc.Graph(id='svd-spec-graph', figure=blank_fig,
+                           style={'height': '50vh'})
+
+svd_values_graph = dcc.Graph(id='svd-values-graph', figure=blank_fig,
+                             style={'height': '50vh'})
+
+svd_kin_graph = dcc.Graph(id='svd-kin-graph', figure=blank_fig,
+                          style={'height': '50vh'})
       
-app.layout = dbc.Container([
-    dbc.Row([
-        dbc.Col([
-            html.H2("StranksLab")
-            ], width=True),
+# Layout is served per page load so every browser tab gets its own session id
+def serve_layout():
+    return dbc.Container([
+        dbc.Row([
             dbc.Col([
-                nav_dropdown], width=1)
-            ], style={'background-color': '#a3c1ad'}, align='end'),
-    html.Hr(),
-    dbc.Row([
-        sidebar,
-        main_graph]),
-    dbc.Row([
-        dbc.Col(spec_graph, width=6),
-        dbc.Col(kin_graph, width=6)]),
-    hidden_triggers               
-    ])
+                html.H2("StranksLab")
+                ], width=True),
+                dbc.Col([
+                    nav_dropdown], width=1)
+                ], style={'background-color': '#a3c1ad'}, align='end'),
+        html.Hr(),
+        dbc.Row([
+            sidebar,
+            main_graph]),
+        dbc.Row([
+            dbc.Col(spec_graph, width=6),
+            dbc.Col(kin_graph, width=6)]),
+        dbc.Row([
+            dbc.Col(svd_spec_graph, width=5),
+            dbc.Col(svd_values_graph, width=2),
+            dbc.Col(svd_kin_graph, width=5)]),
+        hidden_triggers,
+        dcc.Store(id='session-id', data=uuid.uuid4().hex)
+        ])
+
+app.layout = serve_layout
+
+# Instrumentation metrics. Callbacks are labelled by function name, helper
+# timings by stage. The gauges are summed over live processes in multiprocess
+# mode.
+TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+CALLBACK_SECONDS = Histogram('strankslab_callback_seconds',
+                             'Wall time of a callback, including serializing its response',
+                             ['callback'], buckets=TIME_BUCKETS)
+CALLBACK_BYTES = Histogram('strankslab_callback_response_bytes',
+                           'Size of the serialized callback response', ['callback'],
+                           buckets=[2**i for i in range(10, 30, 2)])
+CALLBACK_CALLS = Counter('strankslab_callback_calls',
+                         "Callback calls by outcome ('ok', 'prevented' or 'error')",
+                         ['callback', 'outcome'])
+STAGE_SECONDS = Histogram('strankslab_stage_seconds',
+                          'Wall time of a loading or slicing step', ['stage'],
+                          buckets=TIME_BUCKETS)
+LOADED_BYTES = Gauge('strankslab_loaded_bytes', 'Bytes of arrays held by loaded datasets',
+                     multiprocess_mode='livesum')
+LOADED_DATASETS = Gauge('strankslab_loaded_datasets', 'Number of loaded datasets',
+                        multiprocess_mode='livesum')
+STARTUP_SECONDS = Gauge('strankslab_startup_seconds',
+                        'Time to import the app and to preload files before serving',
+                        ['phase'], multiprocess_mode='max')
+
+# Stages timed during the current callback, per thread, as [depth, stage,
+# seconds] in the order they started. None outside an instrumented callback.
+TIMINGS = threading.local()
+
+# Times a block or, used as a decorator, a function as one stage
+@contextlib.contextmanager
+def timed(stage):
+    stages = getattr(TIMINGS, 'stages', None)
+    depth = getattr(TIMINGS, 'depth', 0)
+    if stages is not None:
+        record = [depth, stage, None]
+        stages.append(record)
+    TIMINGS.depth = depth + 1
+    start = timer.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = timer.perf_counter() - start
+        TIMINGS.depth = depth
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        if stages is not None:
+            record[2] = seconds
+
+# Timing breakdown of one callback: its stages indented by nesting, and the
+# time outside any stage (the callback's own code, serialization, dash)
+def timing_report(name, outcome, seconds, size, stages):
+    lines = ['%s %s: %.1f ms, %.1f kB' % (name, outcome, seconds * 1000, size / 1024)]
+    for depth, stage, stage_seconds in stages:
+        if stage_seconds != None:
+            lines.append('  ' * (depth + 1) + '%s %.1f ms' % (stage, stage_seconds * 1000))
+    other = seconds - sum(s for depth, stage, s in stages if depth == 0 and s != None)
+    lines.append('  other %.1f ms' % (other * 1000))
+    return '\n'.join(lines)
+
+# Wraps the function dash calls for a callback, which returns the serialized
+# response, to record its time, size and outcome
+def instrument_callback(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    def instrumented(*args, **kwargs):
+        TIMINGS.stages = []
+        TIMINGS.depth = 0
+        outcome = 'error'
+        response = None
+        start = timer.perf_counter()
+        try:
+            response = callback(*args, **kwargs)
+            outcome = 'ok'
+            return response
+        except PreventUpdate:
+            outcome = 'prevented'
+            raise
+        finally:
+            seconds = timer.perf_counter() - start
+            size = len(response) if isinstance(response, (str, bytes)) else 0
+            CALLBACK_SECONDS.labels(name).observe(seconds)
+            CALLBACK_CALLS.labels(name, outcome).inc()
+            if outcome == 'ok':
+                CALLBACK_BYTES.labels(name).observe(size)
+            LOADED_BYTES.set(DATA.nbytes)
+            LOADED_DATASETS.set(len(DATA))
+            if LOG_TIMINGS:
+                print(timing_report(name, outcome, seconds, size, TIMINGS.stages))
+            TIMINGS.stages = None
+    return instrumented
+
+# Instruments every server-side callback registered on the app. Called once,
+# after the last callback is defined.
+def instrument_callbacks(app):
+    for spec in app.callback_map.values():
+        if 'callback' in spec:
+            spec['callback'] = instrument_callback(spec['callback'])
+
+@app.server.route('/metrics')
+def metrics():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        body = generate_latest(registry)
+    else:
+        body = generate_latest()
+    return flask.Response(body, content_type=CONTENT_TYPE_LATEST)
+
+# Returns the indices of the elements of a sorted axis closest to each of the
+# given values, resolving any number of values in one vectorized call
+def closest_indices(axis_values, values):
+    axis_values = np.asarray(axis_values)
+    values = np.asarray(values, dtype=np.float64)
+    descending = len(axis_values) > 1 and axis_values[-1] < axis_values[0]
+    if descending:
+        axis_values = axis_values[::-1]
+    if len(axis_values) == 1:
+        return np.zeros(values.shape, dtype=np.intp)
+    pos = np.clip(np.searchsorted(axis_values, values), 1, len(axis_values) - 1)
+    before = axis_values[pos - 1]
+    after = axis_values[pos]
+    pos = np.where(after - values < values - before, pos, pos - 1)
+    if descending:
+        pos = len(axis_values) - 1 - pos
+    return pos
+
+# Converts [min, max] slice bounds into start/stop index arrays along an axis.
+# A band covers the points closest to both of its bounds and everything in
+# between; a bound left empty (None) makes the slice a single point.
+def slice_indices(axis_values, bounds):
+    bounds = np.array([[np.nan if b is None else b for b in pair]
+                       for pair in bounds], dtype=np.float64).reshape(-1, 2)
+    bounds[:, 0] = np.where(np.isnan(bounds[:, 0]), bounds[:, 1], bounds[:, 0])
+    bounds[:, 1] = np.where(np.isnan(bounds[:, 1]), bounds[:, 0], bounds[:, 1])
+    ends = closest_indices(axis_values, bounds)
+    return ends.min(axis=1), ends.max(axis=1) + 1
 
-# Returns index and value of element in list closet to the given number
-def take_closest(my_list, my_number):
-    pos = bisect_left(my_list, my_number)
-    if pos == 0:
-        return [0, my_list[0]]
-    if pos == len(my_list):
-        return [pos, my_list[-1]]
-    before = my_list[pos - 1]
-    after = my_list[pos]
-    if after - my_number < my_number - before:
-        return [pos, after]
+# Dropdown label of a slice typed in as [min, max] bounds in `unit`
+def slice_key(slice_min, slice_max, unit):
+    if slice_max == None:
+        return str(slice_min) + ' ' + unit
+    elif slice_min == None:
+        return str(slice_max) + ' ' + unit
     else:
-        return [pos - 1, before]
+        return str(slice_min) + ' ' + unit + ' - ' + str(slice_max) + ' ' + unit
+
+# Cumulative sums of dtt along an axis (0 = delay, 1 = wavelength) with a
+# leading zero, so the mean over any band is one subtraction. They are saved
+# as shared arrays, built once for all workers. If dtt holds NaNs, cumulative
+# counts of finite values are kept alongside.
+@timed('prefix sums')
+def prefix_sums(data, axis):
+    key = ('prefix', axis)
+    if key not in data.cache:
+        dtt = data.dtt
+        has_nan = not shared_array(data, 'finite', lambda: np.isfinite(dtt).all())
+        sums = shared_array(data, 'prefix' + str(axis), lambda: cumulative(
+            np.nan_to_num(dtt) if has_nan else dtt, axis, np.float64))
+        counts = None
+        if has_nan:
+            counts = shared_array(data, 'prefix' + str(axis) + '_counts', lambda: cumulative(
+                np.isfinite(dtt), axis, np.int32))
+        data.store(key, (sums, counts))
+    return data.cache[key]
+
+# Cumulative sum along `axis` with a leading zero
+def cumulative(values, axis, dtype):
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (1, 0)
+    return np.pad(np.cumsum(values, axis=axis, dtype=dtype), pad)
+
+# Band-averages dtt over every slice in `bounds` along `axis` in one call.
+# Returns a 2-D array with one column per slice: kinetics (delay x slice) when
+# averaging over wavelength bands (axis=1), spectra (wavelength x slice) when
+# averaging over delay windows (axis=0).
+def band_average(data, axis, bounds):
+    if len(bounds) == 0:
+        return np.empty((data.dtt.shape[1 - axis], 0))
+    axis_values = data.time if axis == 0 else data.wavelength
+    return band_means(prefix_sums(data, axis), slice_indices(axis_values, bounds), axis)
+
+# Means over bands from prefix sums (sums, and counts of finite values or None
+# if there are no NaNs) and the bands' (start, stop) indices along `axis`
+def band_means(prefix, indices, axis):
+    (sums, counts), (start, stop) = prefix, indices
+    if axis == 1:
+        total = sums[:, stop] - sums[:, start]
+        n = stop - start if counts is None else counts[:, stop] - counts[:, start]
+    else:
+        total = (sums[stop, :] - sums[start, :]).T
+        n = (stop - start)[None, :] if counts is None else (counts[stop, :] - counts[start, :]).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / n
+
+# Standard errors of band averages (shaped like band_average) when the data
+# comes from averaged scans: the standard errors of the scan average combined
+# in quadrature over each band. Later pipeline stages are not propagated.
+# None if the data isn't a scan average.
+@timed('errors')
+def band_error(data, axis, bounds):
+    stats = pipeline_scans(data)
+    if stats is None:
+        return None
+    key = ('error prefix', axis)
+    if key not in data.cache:
+        variance = np.asarray(stats['stderr'])**2
+        finite = np.isfinite(variance)
+        pad = [(0, 0), (0, 0)]
+        pad[axis] = (1, 0)
+        data.store(key, (np.pad(np.cumsum(np.where(finite, variance, 0), axis=axis), pad),
+                         np.pad(np.cumsum(finite, axis=axis, dtype=np.int32), pad)))
+    sums, counts = data.cache[key]
+    axis_values = data.time if axis == 0 else data.wavelength
+    start, stop = slice_indices(axis_values, bounds)
+    if axis == 1:
+        total, n = sums[:, stop] - sums[:, start], counts[:, stop] - counts[:, start]
+    else:
+        total, n = (sums[stop, :] - sums[start, :]).T, (counts[stop, :] - counts[start, :]).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(total) / n
+
+@timed('kinetics')
+def kinetics(data, wvl_bounds):
+    return band_average(data, 1, wvl_bounds)
+
+@timed('spectra')
+def spectra(data, time_bounds):
+    return band_average(data, 0, time_bounds)
+
+# Leading `rank` singular values and vectors of a (delay x wavelength) matrix
+# by randomized range finding (Halko, Martinsson & Tropp, 2011). Only products
+# with thin (rank + oversamples) column matrices and the SVD of a small matrix
+# are computed, never the full decomposition. Signs are fixed so each spectral
+# vector's largest element is positive.
+def randomized_svd(matrix, rank, oversamples=SVD_OVERSAMPLES,
+                   power_iterations=SVD_POWER_ITERATIONS, seed=0):
+    size = min(rank + oversamples, *matrix.shape)
+    if size == min(matrix.shape):
+        u, s, vt = np.linalg.svd(np.asarray(matrix, dtype=np.float64),
+                                 full_matrices=False)
+    else:
+        dtype = matrix.dtype
+        omega = np.random.default_rng(seed).standard_normal((matrix.shape[1], size))
+        q = np.linalg.qr(matrix @ omega.astype(dtype))[0].astype(dtype)
+        for _ in range(power_iterations):
+            z = np.linalg.qr(matrix.T @ q)[0].astype(dtype)
+            q = np.linalg.qr(matrix @ z)[0].astype(dtype)
+        ub, s, vt = np.linalg.svd(np.asarray(q.T @ matrix, dtype=np.float64),
+                                  full_matrices=False)
+        u = q.astype(np.float64) @ ub
+    u, s, vt = u[:, :rank], s[:rank], vt[:rank]
+    signs = np.sign(vt[np.arange(len(vt)), np.abs(vt).argmax(axis=1)])
+    signs[signs == 0] = 1
+    return u * signs, s, vt * signs[:, None]
+
+# Read-only handle on the dtt block of an 'Average' dataset (row 0 holds the
+# wavelengths and column 0 the delay times, so the block starts at [1, 1]).
+# Nothing is read until the handle is indexed: contiguous, uncompressed
+# datasets are memory-mapped straight from the file, anything else (chunked
+# or filtered) is read by h5py hyperslab selection. Indexing with slices only
+# pulls the requested row/column block into memory.
+class LazyDTT:
+    def __init__(self, filename, name='Average'):
+        self.filename = filename
+        self.name = name
+        self._file = h5py.File(filename, 'r')
+        dset = self._file[name]
+        self.shape = (dset.shape[0] - 1, dset.shape[1] - 1)
+        self.dtype = dset.dtype
+        offset = dset.id.get_offset()
+        if (offset is not None and dset.chunks is None
+                and dset.compression is None and dset.dtype.isnative):
+            self._source = np.memmap(filename, dtype=dset.dtype, mode='r',
+                                     offset=offset, shape=dset.shape)
+            self.mapped = True
+            self._file.close()
+            self._file = None
+        else:
+            self._source = dset
+            self.mapped = False
+
+    ndim = 2
+
+    @property
+    def nbytes(self):
+        return self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        block = self[:, :]
+        if dtype is not None:
+            block = block.astype(dtype, copy=False)
+        return block
+
+    # Converts an index along one axis of the dtt block into a forward slice
+    # of the underlying dataset, plus whatever indexing is left to apply to
+    # the block once it has been read
+    @staticmethod
+    def _shift(index, n):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(n)
+            if step > 0:
+                return slice(start + 1, max(stop, start) + 1, step), slice(None)
+            # Negative steps are read forwards and reversed afterwards
+            count = len(range(start, stop, step))
+            if count == 0:
+                return slice(1, 1), slice(None)
+            first = start + (count - 1) * step
+            return slice(first + 1, start + 2, -step), slice(None, None, -1)
+        if isinstance(index, (int, np.integer)):
+            index = int(index)
+            if index < 0:
+                index += n
+            if not 0 <= index < n:
+                raise IndexError('index ' + str(index) + ' out of range')
+            return slice(index + 1, index + 2), 0
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        index = np.where(index < 0, index + n, index)
+        if index.size == 0:
+            return slice(1, 1), slice(None)
+        lo, hi = int(index.min()), int(index.max())
+        return slice(lo + 1, hi + 2), index - lo
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError('dtt is 2-dimensional')
+        key = key + (slice(None),) * (2 - len(key))
+        rows, row_rest = self._shift(key[0], self.shape[0])
+        cols, col_rest = self._shift(key[1], self.shape[1])
+        block = np.asarray(self._source[rows, cols])
+        if isinstance(row_rest, np.ndarray) and isinstance(col_rest, np.ndarray):
+            return block[np.ix_(row_rest, col_rest)]
+        return block[row_rest, col_rest]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._source = None
+
+# Total bytes held by the arrays in a (possibly nested) dict/list/tuple
+def array_nbytes(obj):
+    if isinstance(obj, np.ndarray) and not isinstance(obj, np.memmap):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(array_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(array_nbytes(v) for v in obj)
+    return 0
 
-# Takes data from .hdf5 file and stores in DataFrame with key equal to filename
-## NEEDS TO BE UPDATED TO ACCOMODATE MORE DELAY TYPES
-def import_data(options, filename):
-    global DATA
+# One loaded file. The axes are small and always kept; dtt is read from the
+# file as one contiguous float32/float64 array the first time it is needed and
+# kept as a shared memory map (see shared_array). Products derived from it
+# (pyramids, cached sums...) go in `cache`. Both are dropped by release() and
+# rebuilt or re-mapped on the next access.
+class Dataset:
+    __slots__ = ('filename', 'name', 'key', 'wavelength', 'time', 'timescale',
+                 'kind', 'average', 'scans', '_source', '_dtt', 'cache', 'registry')
+
+    # `name` is the record's key in DATA, the filename unless it is a
+    # preprocessed view of the file. `kind` is the kind of data (a key of
+    # QUANTITIES), `average` the name of the file's 2-D dataset laid out like
+    # 'Average' (None if there is none) and `scans` the number of scans held.
+    def __init__(self, filename, wavelength, time, timescale, source=None,
+                 name=None, key=None, kind='ta', average='Average', scans=0):
+        self.filename = filename
+        self.kind = kind
+        self.average = average
+        self.scans = scans
+        self.name = name or filename
+        self.key = key or shared_key(filename)
+        self.wavelength = np.ascontiguousarray(wavelength, dtype=np.float64)
+        self.time = np.ascontiguousarray(time, dtype=np.float64)
+        self.timescale = timescale
+        self._source = source
+        self._dtt = None
+        self.cache = {}
+        self.registry = None
+
+    @property
+    def quantity(self):
+        return QUANTITIES[self.kind]
+
+    # Lazy handle on the file, reopened if the record was released. Files
+    # without a dataset laid out like 'Average' are read through dtt.
+    @property
+    def source(self):
+        if self.average is None:
+            return self.dtt
+        if self._source is None:
+            self._source = LazyDTT(self.filename, self.average)
+        return self._source
+
+    @property
+    def dtt(self):
+        if self._dtt is None:
+            self._dtt = shared_array(self, 'dtt', self.read_dtt)
+            if self.registry is not None:
+                self.registry.trim(keep=self.name)
+        return self._dtt
+
+    @timed('read')
+    def read_dtt(self):
+        if self.kind == 'tcspc':
+            return photon_histogram(self.filename)['counts']
+        elif self.kind == 'pl-spectrum':
+            return read_spectra(self.filename)
+        elif self.average is None:
+            return scan_statistics(self)['mean']
+        source = self.source
+        dtype = np.float32 if source.dtype == np.float32 else np.float64
+        return source[:, :].astype(dtype)
+
+    @property
+    def loaded(self):
+        return self._dtt is not None
+
+    # Private memory held by the record. Shared memory maps are not counted.
+    @property
+    def nbytes(self):
+        total = self.wavelength.nbytes + self.time.nbytes
+        return total + array_nbytes(self._dtt) + array_nbytes(self.cache)
+
+    # Stores a derived product and re-checks the memory budget
+    def store(self, key, value):
+        self.cache[key] = value
+        if self.registry is not None:
+            self.registry.trim(keep=self.name)
+        return value
+
+    def release(self):
+        self._dtt = None
+        self.cache = {}
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
+# Loaded files keyed by filename in least to most recently used order. Insert,
+# lookup and delete are O(1). Whenever the arrays held by all records go over
+# `budget` bytes, the least recently used records are released back to disk
+# until the total fits again, and beyond `max_records` records the least
+# recently used are removed (closing their files). Looking up a file this
+# process has not opened (it was imported by another worker, or removed)
+# opens it with `loader`.
+class DatasetRegistry:
+    def __init__(self, budget=DATA_MEMORY_BUDGET, loader=None,
+                 max_records=DATA_MAX_RECORDS):
+        self.budget = budget
+        self.loader = loader
+        self.max_records = max_records
+        self._records = OrderedDict()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def __iter__(self):
+        return iter(list(self._records))
+
+    def __getitem__(self, name):
+        if name not in self._records:
+            if self.loader is None:
+                raise KeyError(name)
+            return self.add(self.loader(name))
+        record = self._records[name]
+        self._records.move_to_end(name)
+        return record
+
+    @property
+    def empty(self):
+        return not self._records
+
+    @property
+    def nbytes(self):
+        return sum(record.nbytes for record in self._records.values())
+
+    def add(self, record):
+        self.remove(record.name)
+        record.registry = self
+        self._records[record.name] = record
+        self.trim(keep=record.name)
+        return record
+
+    def remove(self, name):
+        record = self._records.pop(name, None)
+        if record is not None:
+            record.release()
+            record.registry = None
+
+    def trim(self, keep=None):
+        for name in list(self._records):
+            if len(self._records) <= self.max_records:
+                break
+            if name != keep:
+                self.remove(name)
+        total = self.nbytes
+        for name in list(self._records):
+            if total <= self.budget:
+                break
+            record = self._records[name]
+            if name == keep or record.nbytes == 0:
+                continue
+            total -= record.nbytes
+            record.release()
+            total += record.nbytes
+
+# Writes `path` atomically: write(f) fills a temporary file created next to
+# it, unique to the call (so threads of one worker don't share it either),
+# which is then renamed over it
+def write_atomic(path, write, mode='w'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+# Index entry remembering the content hash of a path for its current size
+# and modification time
+def index_path(filename):
+    ident = os.path.abspath(filename).encode()
+    return os.path.join(CACHE_INDEX_DIR, hashlib.sha1(ident).hexdigest() + '.json')
+
+def remember_hash(filename, digest):
+    stat = os.stat(filename)
+    entry = dict(path=os.path.abspath(filename), size=stat.st_size,
+                 mtime_ns=stat.st_mtime_ns, sha256=digest)
+    write_atomic(index_path(filename), lambda f: json.dump(entry, f))
+
+# Key of a file's shared arrays: the SHA-256 of its contents. The hash is
+# looked up in the index while the file's size and modification time are
+# unchanged, otherwise the file is read and hashed again.
+def shared_key(filename):
+    stat = os.stat(filename)
+    try:
+        with open(index_path(filename)) as f:
+            entry = json.load(f)
+        if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
+    except (OSError, ValueError, KeyError):
+        pass
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    remember_hash(filename, digest.hexdigest())
+    return digest.hexdigest()
+
+# Directory of a record's shared arrays; `data` is a Dataset or a key
+def cache_dir(data):
+    return os.path.join(CACHE_DIR, data if isinstance(data, str) else data.key)
+
+# Marks a key as recently used, for trim_cache
+def touch_cache(data):
+    try:
+        os.utime(cache_dir(data))
+    except OSError:
+        pass
+
+# Deletes the least recently used keys until the cache and the upload spool
+# together fit in max_bytes. A spooled upload is named by its SHA-256, which
+# is also its key, so it goes with its key (and counts as used when the key
+# is). Keys of records open in this process are kept; other workers that
+# still map a deleted array keep their mapping until they close it. Expired
+# sessions and job statuses are deleted at the same time.
+def trim_cache(max_bytes=CACHE_MAX_BYTES):
+    expire_state()
+    keep = {DATA[name].key for name in DATA}
+    entries = {}
+    for key in (os.listdir(CACHE_DIR) if os.path.isdir(CACHE_DIR) else []):
+        path = os.path.join(CACHE_DIR, key)
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, dirs, files in os.walk(path) for name in files)
+        entries[key] = [os.path.getmtime(path), size, [path]]
+    for name in (os.listdir(SPOOL_DIR) if os.path.isdir(SPOOL_DIR) else []):
+        key = os.path.splitext(name)[0]
+        if not re.fullmatch('[0-9a-f]{64}', key):
+            continue
+        path = os.path.join(SPOOL_DIR, name)
+        entry = entries.setdefault(key, [os.path.getmtime(path), 0, []])
+        entry[1] += os.path.getsize(path)
+        entry[2].append(path)
+    total = sum(size for _, size, _ in entries.values())
+    for key, (_, size, paths) in sorted(entries.items(), key=lambda item: item[1][0]):
+        if total <= max_bytes:
+            break
+        if key not in keep:
+            for path in paths:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+            total -= size
+
+# Returns a read-only memory map of the array `name` for a file, building it
+# with `build` and saving it under SHARED_DIR first if no worker has done so
+# yet. The array is written to a temporary file and renamed into place, so no
+# worker ever maps a half-written file.
+def shared_array(data, name, build):
+    path = os.path.join(cache_dir(data), name + '.npy')
+    if not os.path.exists(path):
+        array = np.ascontiguousarray(build())
+        write_atomic(path, lambda f: np.save(f, array), 'wb')
+    return np.load(path, mmap_mode='r')
+
+def shared_exists(data, name):
+    return os.path.exists(os.path.join(cache_dir(data), name))
+
+# Same as shared_array for a group of arrays built together: `build` returns a
+# dict of arrays, saved in one directory that is renamed into place whole
+def shared_arrays(data, name, build):
+    path = os.path.join(cache_dir(data), name)
+    if not os.path.isdir(path):
+        arrays = build()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = tempfile.mkdtemp(dir=os.path.dirname(path), suffix='.tmp')
+        for field, array in arrays.items():
+            np.save(os.path.join(temp, field + '.npy'), np.ascontiguousarray(array))
+        try:
+            os.replace(temp, path)
+        except OSError:
+            # Another worker got there first
+            shutil.rmtree(temp, ignore_errors=True)
+    return {field[:-4]: np.load(os.path.join(path, field), mmap_mode='r')
+            for field in os.listdir(path) if field.endswith('.npy')}
+
+def attr_text(attrs, name):
+    value = attrs.get(name)
+    if isinstance(value, bytes):
+        value = value.decode()
+    return None if value is None else str(value).strip()
+
+# Delay unit of a dataset from its 'delay unit' or 'delay type' attribute
+def delay_unit(attrs, default='fs'):
+    unit = attr_text(attrs, 'delay unit')
+    if unit:
+        return DELAY_TYPES.get(unit.lower(), unit)
+    return DELAY_TYPES.get((attr_text(attrs, 'delay type') or '').lower(), default)
+
+# Per-scan datasets of an open file as (name, frame) pairs, frame being the
+# index into a 3-D dataset or None for a 2-D one, in scan order
+def scan_datasets(f):
+    scans = f.get('Scans')
+    if isinstance(scans, h5py.Dataset) and scans.ndim == 3:
+        return [('Scans', i) for i in range(scans.shape[0])]
+    found = []
+    for group in ([scans] if isinstance(scans, h5py.Group) else []) + [f]:
+        for name, item in group.items():
+            match = re.match(r'scan\D*(\d+)$', name, re.IGNORECASE)
+            if match and isinstance(item, h5py.Dataset) and item.ndim == 2:
+                found.append((int(match.group(1)), item.name))
+    return [(name, None) for _, name in sorted(found)]
+
+def scan_block(f, scan, rows):
+    name, frame = scan
+    if frame is None:
+        return f[name][rows.start + 1:rows.stop + 1, 1:]
+    return f[name][frame, rows.start + 1:rows.stop + 1, 1:]
+
+# Steady-state PL spectra as (spectrum x wavelength)
+def read_spectra(filename):
+    with h5py.File(filename, 'r') as f:
+        return f['PL Spectrum'][:, 1:].T
+
+# Histograms the photons of a TCSPC file into counts (delay bin x channel).
+# Each chunk of PHOTON_CHUNK records is binned with one np.bincount over
+# combined (delay bin, channel) indices and added to the running histogram,
+# which grows whenever photons arrive in later bins. Returns the delay axis
+# (bin centres, ns), the channel wavelengths and the counts.
+@timed('photons')
+def photon_histogram(filename):
     with h5py.File(filename, 'r') as f:
-        wavelength = f['Average'][0, 1:]
-        time = f['Average'][1:, 0]
-        dtt = f['Average'][1:, 1:]
-        delay_type = f['Average'].attrs['delay type']
-    if delay_type == 'Short':
-        timescale = 'fs'
-    elif delay_type == 'Long':
-        timescale = 'ps'
+        photons = f['Photons']
+        dtime = photons['dtime']
+        channel = photons.get('channel')
+        resolution = float(photons.attrs.get('resolution', TCSPC_BIN_SECONDS))
+        # Without wavelengths the channels are numbered, and like the delay
+        # bins they are added as photons turn up in them
+        wavelength = None
+        if 'wavelength' in photons:
+            wavelength = photons['wavelength'][:].astype(np.float64)
+        ticks = max(1, int(round(TCSPC_BIN_SECONDS / resolution)))
+        n = 1 if wavelength is None else len(wavelength)
+        counts = np.zeros((0, n), np.int64)
+        for start in range(0, len(dtime), PHOTON_CHUNK):
+            bins = dtime[start:start + PHOTON_CHUNK].astype(np.int64) // ticks
+            index = np.zeros(len(bins), np.int64) if channel is None else \
+                channel[start:start + PHOTON_CHUNK].astype(np.int64)
+            if wavelength is None and len(index) and index.max() >= n:
+                n = int(index.max()) + 1
+                counts = np.pad(counts, ((0, 0), (0, n - counts.shape[1])))
+            valid = (bins >= 0) & (index >= 0) & (index < n)
+            flat = np.bincount(bins[valid] * n + index[valid])
+            rows = -(-len(flat) // n)
+            if rows > len(counts):
+                counts = np.pad(counts, ((0, rows - len(counts)), (0, 0)))
+            counts[:rows] += np.pad(flat, (0, rows * n - len(flat))).reshape(rows, n)
+    if wavelength is None:
+        wavelength = np.arange(n, dtype=np.float64)
+    order = np.argsort(wavelength)
+    time = (np.arange(len(counts)) + 0.5) * ticks * resolution * 1e9
+    return dict(time=time, wavelength=wavelength[order],
+                counts=counts[:, order].astype(np.float64))
+
+# Axes, delay unit, kind and scan count of a file. TA axes come from 'Average'
+# or else its first scan. A TCSPC file is histogrammed here, as the delay axis
+# depends on the photons, and the counts saved as the file's dtt under `key`
+# (or, with no key, returned as 'dtt').
+def read_axes(filename, key):
+    with h5py.File(filename, 'r') as f:
+        header = dict(kind='ta', average='', scans=0)
+        if 'Photons' in f:
+            histogram = photon_histogram(filename)
+            if key == None:
+                header['dtt'] = histogram['counts']
+            else:
+                shared_array(key, 'dtt', lambda: histogram['counts'])
+            header.update(kind='tcspc', time=histogram['time'],
+                          wavelength=histogram['wavelength'], timescale='ns')
+        elif 'PL Spectrum' in f:
+            spectra = f['PL Spectrum']
+            header.update(kind='pl-spectrum', wavelength=spectra[:, 0],
+                          time=np.arange(spectra.shape[1] - 1, dtype=np.float64),
+                          timescale=delay_unit(spectra.attrs, ''))
+        elif 'PL Map' in f:
+            pl_map = f['PL Map']
+            header.update(kind='pl-map', average='PL Map', wavelength=pl_map[0, 1:],
+                          time=pl_map[1:, 0], timescale=delay_unit(pl_map.attrs, 'ns'))
+        else:
+            scans = scan_datasets(f)
+            average = f.get('Average')
+            if average is not None:
+                block, attrs = average, average.attrs
+            elif scans:
+                name, frame = scans[0]
+                block = f[name] if frame is None else f[name][frame]
+                attrs = f[name].attrs
+            else:
+                raise KeyError('No TA or PL datasets in ' + filename)
+            header.update(wavelength=block[0, 1:], time=block[1:, 0],
+                          timescale=delay_unit(attrs), scans=len(scans),
+                          average='' if average is None else 'Average')
+    return {field: np.asarray(value) for field, value in header.items()}
+
+# Reads the axes of an .hdf5 file into a Dataset record. The axes are saved in
+# the cache, so a file opened before costs no HDF5 read at all; dtt is only
+# read (through a LazyDTT handle) if it isn't cached either.
+@timed('open')
+def open_dataset(filename):
+    key = shared_key(filename)
+    touch_cache(key)
+    layout = shared_arrays(key, 'layout', lambda: read_axes(filename, key))
+    return Dataset(filename, layout['wavelength'], layout['time'],
+                   str(layout['timescale'].item()), key=key,
+                   kind=str(layout['kind'].item()),
+                   average=str(layout['average'].item()) or None,
+                   scans=int(layout['scans'].item()))
+
+# Streams through a file's scans, one block of delay rows from every scan at a
+# time, and returns per point: 'mean', 'std' (between scans), 'stderr' (of the
+# mean), 'clipped' (mean of the points within SCAN_CLIP_SIGMA robust standard
+# deviations of the median) and 'count' (scans in the mean); per scan:
+# 'deviation' (mean distance from the median, each distance capped at
+# SCAN_CLIP_SIGMA robust standard deviations so single spikes, which the
+# clipping already handles, don't flag a scan) and 'outlier'. Scans listed in
+# `exclude` are skipped. Memory use is one block plus the outputs.
+@timed('scan statistics')
+def scan_statistics(data, exclude=()):
+    exclude = sorted(set(int(i) for i in exclude))
+    name = 'scan_statistics_' + '_'.join(str(v) for v in [SCAN_CLIP_SIGMA, SCAN_OUTLIER_SIGMA,
+                                                SCAN_OUTLIER_EXCESS] + exclude)
+    if ('scans', name) in data.cache:
+        return data.cache[('scans', name)]
+    def build():
+        shape = (len(data.time), len(data.wavelength))
+        out = {field: np.full(shape, np.nan) for field in ('mean', 'std', 'clipped')}
+        out['count'] = np.zeros(shape, np.int32)
+        with h5py.File(data.filename, 'r') as f:
+            scans = scan_datasets(f)
+            used = [i for i in range(len(scans)) if i not in exclude]
+            if not used:
+                raise ValueError('No scans to average in ' + data.filename)
+            distances = np.zeros(len(used))
+            points = np.zeros(len(used))
+            step = max(1, SCAN_BLOCK_BYTES // (8 * len(used) * shape[1]))
+            for start in range(0, shape[0], step):
+                rows = slice(start, min(start + step, shape[0]))
+                block = np.stack([scan_block(f, scans[i], rows) for i in used]
+                                 ).astype(np.float64)
+                finite = np.isfinite(block)
+                count = finite.sum(axis=0)
+                with np.errstate(invalid='ignore', divide='ignore'), \
+                        warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    out['mean'][rows] = np.nanmean(block, axis=0)
+                    out['std'][rows] = np.nanstd(block, axis=0, ddof=1)
+                    median = np.nanmedian(block, axis=0)
+                    distance = np.abs(block - median)
+                    spread = 1.4826 * np.nanmedian(distance, axis=0)
+                    keep = finite & ((distance <= SCAN_CLIP_SIGMA * spread) | (spread == 0))
+                    out['clipped'][rows] = (np.where(keep, block, 0).sum(axis=0)
+                                            / keep.sum(axis=0))
+                    distance = np.where(spread > 0, np.fmin(distance, SCAN_CLIP_SIGMA * spread),
+                                        distance)
+                out['count'][rows] = count
+                distances += np.where(finite, distance, 0).reshape(len(used), -1).sum(axis=1)
+                points += finite.reshape(len(used), -1).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['stderr'] = out['std'] / np.sqrt(out['count'])
+            deviation = distances / points
+        typical = np.nanmedian(deviation)
+        spread = 1.4826 * np.nanmedian(np.abs(deviation - typical))
+        out['deviation'] = np.full(len(scans), np.nan)
+        out['deviation'][used] = deviation
+        out['outlier'] = np.zeros(len(scans), bool)
+        out['outlier'][used] = deviation - typical > max(SCAN_OUTLIER_SIGMA * spread,
+                                                         SCAN_OUTLIER_EXCESS * typical)
+        return out
+    return data.store(('scans', name), shared_arrays(data, name, build))
+
+# Output of one preprocessing stage run on `parent` (a file's Dataset or the
+# previous stage). Its key hashes the parent's key with the stage's name and
+# parameters, so its dtt is saved once as a shared array and reused by every
+# pipeline that starts with the same stages.
+class ProcessedDataset(Dataset):
+    __slots__ = ('parent', 'stage', 'params')
+
+    def __init__(self, parent, stage, params, name):
+        ident = '|'.join([parent.key, stage, json.dumps(params, sort_keys=True)])
+        time = parent.time
+        if stage in PIPELINE_AXES:
+            time = PIPELINE_AXES[stage](parent, **params)
+        Dataset.__init__(self, parent.filename, parent.wavelength, time,
+                         parent.timescale, name=name, kind=parent.kind,
+                         key=hashlib.sha1(ident.encode()).hexdigest())
+        self.parent = parent
+        self.stage = stage
+        self.params = params
+        touch_cache(self)
+
+    # Views that read blocks of the file read the stage's output instead
+    @property
+    def source(self):
+        return self.dtt
+
+    @timed('pipeline')
+    def read_dtt(self):
+        dtt = PIPELINE_STAGES[self.stage](self.parent, **self.params)
+        return np.asarray(dtt, dtype=self.parent.dtt.dtype)
+
+# Pipeline stages. Each takes the previous stage's Dataset and returns a new
+# dtt (delay x wavelength); masked or undefined points are NaN.
+
+# Replaces the file's average with one computed from its scans: 'mean',
+# 'clipped' or, to look at the noise, 'stderr'. Always the first stage.
+def average_scans(data, method='clipped', exclude=()):
+    return scan_statistics(data, exclude)[method]
+
+# Scan statistics behind a pipeline output, if its pipeline averages scans
+# (None after a stage that changes the delay axis)
+def pipeline_scans(data):
+    while isinstance(data, ProcessedDataset):
+        if data.stage in PIPELINE_AXES:
+            return None
+        if data.stage == 'average':
+            return scan_statistics(data.parent, data.params['exclude'])
+        data = data.parent
+    return None
+
+# Subtracts the mean signal at delays before `before` (pump-probe background,
+# scattered pump) from every wavelength
+def subtract_background(data, before):
+    rows = data.time < before
+    if not rows.any():
+        raise ValueError('No delays before ' + str(before) + ' ' + data.timescale)
+    with np.errstate(invalid='ignore'):
+        return data.dtt - np.nanmean(data.dtt[rows], axis=0)
+
+# Linear interpolation of every column of `columns` (x x n) at its own
+# query points (queries, same shape), NaN outside x. x must be ascending.
+def interp_columns(x, columns, queries):
+    pos = np.clip(np.searchsorted(x, queries), 1, len(x) - 1)
+    x0 = x[pos - 1]
+    weight = (queries - x0) / (x[pos] - x0)
+    index = np.arange(columns.shape[1])
+    lower = columns[pos - 1, index]
+    result = lower + weight * (columns[pos, index] - lower)
+    result[(queries < x[0]) | (queries > x[-1])] = np.nan
+    return result
+
+# Removes the chirp of the probe: time zero at each wavelength is the
+# polynomial t0(wl) = c0 + c1 (wl - reference) + c2 (wl - reference)^2 + ...
+# and every column is resampled so its time zero lands on delay 0
+def correct_chirp(data, coefficients, reference):
+    t0 = np.polynomial.polynomial.polyval(data.wavelength - reference, coefficients)
+    order = np.argsort(data.time)
+    time = data.time[order]
+    queries = data.time[:, None] + t0[None, :]
+    return interp_columns(time, np.asarray(data.dtt)[order], queries)
+
+# Masks bad detector pixels: wavelengths whose point-to-point noise is more
+# than `threshold` robust standard deviations (MAD) from the median, and any
+# wavelength inside the [min, max] `bands`
+def mask_bad_pixels(data, threshold=None, bands=()):
+    dtt = np.array(data.dtt)
+    bad = np.zeros(dtt.shape[1], bool)
+    if threshold is not None and dtt.shape[0] > 1:
+        noise = np.nanmedian(np.abs(np.diff(dtt, axis=0)), axis=0)
+        spread = 1.4826 * np.nanmedian(np.abs(noise - np.nanmedian(noise)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bad |= np.abs(noise - np.nanmedian(noise)) > threshold * spread
+    for lo, hi in bands:
+        lo = data.wavelength.min() if lo is None else lo
+        hi = data.wavelength.max() if hi is None else hi
+        bad |= (data.wavelength >= min(lo, hi)) & (data.wavelength <= max(lo, hi))
+    dtt[:, bad] = np.nan
+    return dtt
+
+# Centred moving average of `width` points along `axis`, ignoring NaNs.
+# Built from cumulative sums so the cost doesn't depend on the width.
+def moving_average(dtt, width, axis):
+    if width <= 1:
+        return dtt
+    finite = np.isfinite(dtt)
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (1, 0)
+    sums = np.pad(np.cumsum(np.where(finite, dtt, 0), axis=axis, dtype=np.float64), pad)
+    counts = np.pad(np.cumsum(finite, axis=axis, dtype=np.int32), pad)
+    n = dtt.shape[axis]
+    start = np.clip(np.arange(n) - width // 2, 0, n)
+    stop = np.clip(np.arange(n) - width // 2 + width, 0, n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = ((np.take(sums, stop, axis=axis) - np.take(sums, start, axis=axis))
+                / (np.take(counts, stop, axis=axis) - np.take(counts, start, axis=axis)))
+    return np.where(finite, mean, np.nan)
+
+def smooth_dtt(data, time_points=1, wavelength_points=1):
+    return moving_average(moving_average(np.asarray(data.dtt), int(time_points), 0),
+                          int(wavelength_points), 1)
+
+# Lin-log delay scale: linear within +-threshold of time zero, logarithmic
+# (one unit per decade) beyond it, and its inverse
+def linlog(t, threshold):
+    a = np.abs(t) / threshold
+    return np.sign(t) * np.where(a <= 1, a, 1 + np.log10(np.maximum(a, 1)))
+
+def linlog_inverse(u, threshold):
+    a = np.abs(u)
+    return np.sign(u) * threshold * np.where(a <= 1, a, 10**(np.maximum(a, 1) - 1))
+
+# Edges of `points` delay bins spanning `time`, evenly spaced on a 'linear',
+# 'log' or 'linlog' scale. 'linlog' is linear out to `threshold` either side
+# of time zero. 'log' puts the threshold at the earliest delay (or the first
+# positive one), so the delays before time zero get linear bins and the rest
+# logarithmic ones.
+def delay_grid(time, mode, points, threshold=None):
+    lo, hi = np.nanmin(time), np.nanmax(time)
+    if mode == 'linear':
+        edges = np.linspace(lo, hi, points + 1)
     else:
-        timescale = 'fs'
-    new_data = pd.DataFrame(
-        {filename: [wavelength, time, dtt, timescale]},
-        index = ['wavelength', 'time', 'dtt', 'timescale']) 
-    DATA = pd.concat([DATA, new_data], axis=1)
-    options[filename] = filename
+        if mode == 'log' or threshold == None:
+            positive = time[time > 0]
+            threshold = -lo if lo < 0 else (positive.min() if len(positive) else 1.0)
+        edges = linlog_inverse(np.linspace(linlog(lo, threshold), linlog(hi, threshold),
+                                           points + 1), threshold)
+    edges[0], edges[-1] = lo, np.nextafter(hi, np.inf)
+    return edges
+
+# Weighted average of the rows of `values` (sampled at the delays `time`) over
+# delay bins with the given edges. Each sample stands for the span between the
+# midpoints to its neighbours and counts in a bin by how much of that span the
+# bin covers, so dense and sparse stretches of the delay axis are weighted
+# alike; NaN samples carry no weight. Each bin is the difference of running
+# integrals at its edges, for every column at once. Bins holding no sample
+# are dropped rather than filled in from a neighbour.
+def rebin_rows(time, values, edges):
+    order = np.argsort(time)
+    time = time[order]
+    values = values[order]
+    cells = np.concatenate([time[:1], (time[1:] + time[:-1]) / 2, time[-1:]])
+    width = np.diff(cells)[:, None]
+    cell = np.clip(np.searchsorted(cells, edges, 'right') - 1, 0, len(time) - 1)
+    part = (np.clip(edges, cells[cell], cells[cell + 1]) - cells[cell])[:, None]
+    def integral(y):
+        sums = np.pad(np.cumsum(y * width, axis=0), ((1, 0), (0, 0)))
+        return np.diff(sums[cell] + y[cell] * part, axis=0)
+    finite = np.isfinite(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned = integral(np.where(finite, values, 0)) / integral(finite.astype(np.float64))
+    occupied = np.diff(np.searchsorted(time, edges)) > 0
+    return binned[occupied]
+
+# Delays of the rebinned rows: the weighted mean delay of each occupied bin
+def rebin_delays(data, mode, points, threshold=None):
+    edges = delay_grid(data.time, mode, points, threshold)
+    return rebin_rows(data.time, data.time[:, None].astype(np.float64), edges)[:, 0]
+
+# Resamples dtt onto a delay grid of `points` bins (see delay_grid) by
+# weighted averaging. Long logarithmic delay scans shrink to a few hundred
+# rows that are evenly spaced on the log axis.
+def rebin_dtt(data, mode, points, threshold=None):
+    edges = delay_grid(data.time, mode, points, threshold)
+    return rebin_rows(data.time, np.asarray(data.dtt), edges)
+
+PIPELINE_STAGES = OrderedDict([
+    ('average', average_scans),
+    ('background', subtract_background),
+    ('chirp', correct_chirp),
+    ('mask', mask_bad_pixels),
+    ('smooth', smooth_dtt),
+    ('rebin', rebin_dtt)])
+
+# Stages that change the delay axis, with the function giving the new one
+PIPELINE_AXES = {'rebin': rebin_delays}
+
+def pipeline_path(pipeline_id):
+    return os.path.join(PIPELINE_DIR, pipeline_id + '.json')
+
+# Name in DATA of a file seen through a pipeline, given as [[stage, params],
+# ...]: the filename itself when there are no stages, filename#<id> otherwise.
+# The stages are saved under <id> so any worker can open the selection.
+def pipeline_selection(filename, pipeline):
+    if not pipeline:
+        return filename
+    text = json.dumps(pipeline, sort_keys=True)
+    pipeline_id = hashlib.sha1(text.encode()).hexdigest()[:16]
+    path = pipeline_path(pipeline_id)
+    if not os.path.exists(path):
+        write_atomic(path, lambda f: f.write(text))
+    return filename + '#' + pipeline_id
+
+# Files the server opens for a browser: uploads in SPOOL_DIR, files in
+# WATCH_DIR and those imported on the server (preloaded, benchmarked).
+# Selections come from the browser, so any other path, or anything that isn't
+# a regular file (which would be hashed whole before being read), is refused.
+ALLOWED_FILES = set()
+
+def allowed_file(filename):
+    path = os.path.abspath(filename)
+    directory = os.path.dirname(path)
+    return os.path.isfile(path) and (
+        path in ALLOWED_FILES or directory == os.path.abspath(SPOOL_DIR) or
+        (WATCH_DIR != None and directory == os.path.abspath(WATCH_DIR)))
+
+# Loader for DATA: a plain filename opens the file, filename#<id> chains the
+# saved stages onto the file's record
+def open_selection(selection):
+    filename, sep, pipeline_id = selection.rpartition('#')
+    if sep and not re.fullmatch('[0-9a-f]{16}', pipeline_id):
+        raise KeyError('Unknown preprocessing ' + pipeline_id)
+    if not sep:
+        path, at, scans = selection.rpartition('@')
+        if not allowed_file(selection) and not (at and scans.isdigit() and allowed_file(path)):
+            raise KeyError('Unknown file ' + selection)
+        if at and scans.isdigit() and is_live(path):
+            return open_live(path, int(scans))
+        elif is_live(selection):
+            return open_live(selection)
+        return open_dataset(selection)
+    with open(pipeline_path(pipeline_id)) as f:
+        pipeline = json.load(f)
+    data = DATA[filename]
+    for stage, params in pipeline:
+        data = ProcessedDataset(data, stage, params, selection)
+    return data
+
+DATA = DatasetRegistry(DATA_MEMORY_BUDGET, loader=open_selection)
+
+# Takes data from .hdf5 file and stores it in DATA with key equal to filename.
+# The dropdown shows `label` (the uploaded file's name) if given. Callers
+# only pass files the server chose, so the file is allowed from then on.
+@timed('import')
+def import_data(options, filename, label=None):
+    ALLOWED_FILES.add(os.path.abspath(filename))
+    if filename not in DATA:
+        DATA.add(open_dataset(filename))
+    options[filename] = label or filename
     return options
 
+# Files being acquired. LIVE holds, per path, the running sums over the scans
+# read so far: 'scans' (how many), 'sum' and 'count' (finite values per
+# point), the axes, 'origin' (a hash of the first scan, part of the cache key)
+# and the file's inode and modification time when last read, so a file that
+# hasn't changed isn't opened again. Each worker keeps its own sums; the
+# averages are shared through the cache under live_key. NOT_LIVE remembers the
+# watched files found not to be acquisitions, and UNREADABLE those that could
+# not be imported, by modification time and size, so they are only looked at
+# again once they change.
+LIVE = {}
+NOT_LIVE = {}
+UNREADABLE = {}
+
+def is_live(path):
+    if path in LIVE:
+        return True
+    if WATCH_DIR == None or os.path.dirname(os.path.abspath(path)) != os.path.abspath(WATCH_DIR):
+        return False
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if NOT_LIVE.get(path) == (stat.st_mtime_ns, stat.st_size):
+        return False
+    try:
+        with h5py.File(path, 'r', libver='latest', swmr=True) as f:
+            scans = f.get('Scans')
+            live = isinstance(scans, h5py.Dataset) and scans.ndim == 3
+    except OSError:
+        live = False
+    if not live:
+        NOT_LIVE[path] = (stat.st_mtime_ns, stat.st_size)
+    return live
+
+def live_key(path, state):
+    return hashlib.sha256((os.path.abspath(path) + '|' + state['origin'] + '|' +
+                           str(state['scans'])).encode()).hexdigest()
+
+# Brings the running sums of a file being acquired up to `limit` scans, or
+# every complete scan, reading only the scans not yet added. The file is opened
+# in SWMR mode so the acquisition can keep writing, and not at all if it hasn't
+# changed since the last call. A file replaced or rewritten with fewer scans is
+# a new acquisition and starts new sums. Sums that are already past `limit`
+# (another tab asked for an older average) are rebuilt separately and not kept.
+@timed('live')
+def update_live(path, limit=None):
+    stat = os.stat(path)
+    settled = timer.time() - stat.st_mtime >= WATCH_SETTLE_SECONDS
+    current = LIVE.get(path)
+    if (current != None and current['inode'] == stat.st_ino and
+            (limit == current['scans'] or limit == None and
+             current['mtime_ns'] == stat.st_mtime_ns and (current['settled'] or not settled))):
+        return current
+    with h5py.File(path, 'r', libver='latest', swmr=True) as f:
+        scans = f['Scans']
+        scans.refresh()
+        available = scans.shape[0]
+        if available and not settled:
+            available -= 1
+        if available == 0:
+            raise ValueError('No complete scans in ' + os.path.basename(path) + ' yet')
+        if current != None and (current['inode'] != stat.st_ino or available < current['scans']):
+            current = None
+        if current != None and (limit == None or limit >= current['scans']):
+            state = current
+        else:
+            first = scans[0]
+            state = dict(scans=0, origin=hashlib.sha256(first.tobytes()).hexdigest(),
+                         inode=stat.st_ino, time=first[1:, 0], wavelength=first[0, 1:],
+                         timescale=delay_unit(scans.attrs),
+                         sum=np.zeros((first.shape[0] - 1, first.shape[1] - 1)),
+                         count=np.zeros((first.shape[0] - 1, first.shape[1] - 1), np.int64))
+            if current == None:
+                LIVE[path] = state
+        target = available if limit == None else min(limit, available)
+        for scan in range(state['scans'], target):
+            frame = scans[scan, 1:, 1:]
+            finite = np.isfinite(frame)
+            state['sum'] += np.where(finite, frame, 0)
+            state['count'] += finite
+        state['scans'] = max(state['scans'], target)
+        state.update(mtime_ns=stat.st_mtime_ns, settled=settled)
+    return state
+
+# Record of a file being acquired, averaged over its first `scans` scans (all
+# complete scans if None). The average is saved under the record's key when it
+# is opened, so every worker sees the same data for the same scan count.
+class LiveDataset(Dataset):
+    __slots__ = ()
+
+    def read_dtt(self):
+        scans = self.name[len(self.filename) + 1:]
+        state = update_live(self.filename, int(scans) if scans else None)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return state['sum'] / state['count']
+
+@timed('open')
+def open_live(path, scans=None):
+    state = update_live(path, scans)
+    key = live_key(path, state)
+    # The arrays of the count this one supersedes are no longer needed
+    if state is LIVE.get(path) and state.get('key') not in (None, key):
+        shutil.rmtree(cache_dir(state['key']), ignore_errors=True)
+    state['key'] = key
+    touch_cache(key)
+    data = LiveDataset(path, state['wavelength'], state['time'], state['timescale'],
+                       name=path + '@' + str(state['scans']) if scans != None else path,
+                       key=key, average=None)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shared_array(key, 'dtt', lambda: state['sum'] / state['count'])
+    return data
+
+# Selection of the current average of a live file, <path>@<scans>
+def live_selection(path):
+    return path + '@' + str(update_live(path)['scans'])
+
+# Scan count of a live selection, None for any other
+def selection_scans(selection):
+    filename = (selection or '').rpartition('#')[0] or selection or ''
+    path, at, scans = filename.rpartition('@')
+    return int(scans) if at and scans.isdigit() else None
+
+# The file part of a selection, without its preprocessing or scan count
+def selection_filename(selection):
+    filename = selection.rpartition('#')[0] or selection
+    path, at, scans = filename.rpartition('@')
+    return path if at and scans.isdigit() and is_live(path) else filename
+
+def watched_files():
+    try:
+        names = sorted(os.listdir(WATCH_DIR))
+    except (OSError, TypeError):
+        return []
+    return [os.path.join(WATCH_DIR, name) for name in names
+            if os.path.splitext(name)[1].lower() in ('.hdf5', '.h5')]
+
+# Streams the request body to a temporary file in SPOOL_DIR while hashing it,
+# then moves it to <sha256><ext>. If that file already exists the new copy is
+# dropped. Memory use is one chunk whatever the size of the upload.
+def spool_upload(stream, name):
+    ext = os.path.splitext(name)[1].lower() or '.hdf5'
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, temp = tempfile.mkstemp(dir=SPOOL_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+        path = os.path.join(SPOOL_DIR, digest.hexdigest() + ext)
+        if os.path.exists(path):
+            os.remove(temp)
+            touch_cache(digest.hexdigest())
+        else:
+            os.replace(temp, path)
+            remember_hash(path, digest.hexdigest())
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    return path, digest.hexdigest()
+
+# Background jobs. Status files are written atomically so any web worker can
+# poll any job: {'state': 'queued'|'running'|'done'|'error', 'progress': 0-1,
+# 'message': ..., 'path': ..., 'name': ...}. A status is deleted once its
+# final state has been reported, or by trim_cache if no tab ever asks.
+def job_path(job_id):
+    return os.path.join(JOB_DIR, re.sub(r'[^\w-]', '', str(job_id)) + '.json')
+
+def write_job(job_id, **status):
+    write_atomic(job_path(job_id), lambda f: json.dump(status, f))
+
+def read_job(job_id):
+    try:
+        with open(job_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict(state='error', progress=1, message='Job ' + str(job_id) + ' not found')
+
+def remove_job(job_id):
+    try:
+        os.remove(job_path(job_id))
+    except OSError:
+        pass
+
+# The pool is started lazily from a web worker, which may be running other
+# threads. A forked child could inherit a lock (h5py's among them) held by one
+# of those threads and deadlock, so the pool processes start from a fork
+# server, or are spawned where there is none.
+def job_pool():
+    global JOB_POOL
+    if JOB_POOL is None:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        JOB_POOL = ProcessPoolExecutor(max_workers=JOB_WORKERS,
+                                       mp_context=multiprocessing.get_context(method))
+    return JOB_POOL
+
+# Job run in the pool for a newly added file: reads the axes, then saves dtt,
+# its prefix sums and the heatmap pyramid as shared arrays, so the web workers
+# only ever map finished arrays
+def prepare_dataset(job_id, path, name):
+    status = dict(path=path, name=name)
+    steps = [('Reading ' + name, lambda data: data.dtt),
+             ('Summing slices', lambda data: [prefix_sums(data, axis) for axis in (0, 1)]),
+             ('Building heatmap', lambda data: get_pyramid(path))]
+    try:
+        write_job(job_id, state='running', progress=0, message='Opening ' + name, **status)
+        data = DATA.add(open_dataset(path))
+        for index, (message, step) in enumerate(steps):
+            write_job(job_id, state='running', progress=(index + 1) / (len(steps) + 1),
+                      message=message, **status)
+            step(data)
+        DATA.remove(path)
+        trim_cache()
+        write_job(job_id, state='done', progress=1, message=name + ' ready', **status)
+    except Exception:
+        traceback.print_exc()
+        write_job(job_id, state='error', progress=1,
+                  message='Could not load ' + name, **status)
+
+def submit_import(path, name):
+    job_id = uuid.uuid4().hex
+    write_job(job_id, state='queued', progress=0, message='Waiting to load ' + name,
+              path=path, name=name)
+    job_pool().submit(prepare_dataset, job_id, path, name)
+    return job_id
+
+# Upload endpoint used by assets/upload.js. The file is the raw request body
+# and its original name is passed as ?name=
+@app.server.route('/upload', methods=['POST'])
+def upload_file():
+    name = secure_filename(flask.request.args.get('name', '')) or 'upload.hdf5'
+    path, sha256 = spool_upload(flask.request.stream, name)
+    if not h5py.is_hdf5(path):
+        os.remove(path)
+        return flask.jsonify(error=name + ' is not an HDF5 file'), 400
+    return flask.jsonify(path=path, name=name, sha256=sha256)
+
 def delete_data(options, value):
-    global DATA
     if value == None:
         return no_update, no_update
     else:
-        DATA.drop(columns=value)
+        for name in DATA:
+            if name == value or name.startswith(value + '#') or name.startswith(value + '@'):
+                DATA.remove(name)
         del options[value]
         return options, None
     
+# Per-session state, one small JSON file per browser tab under SHARED_DIR so
+# that every worker process sees the same slices for a session. Slices are
+# kept as {'time': {key: [min, max]}, 'wvl': {key: [min, max]}} in the order
+# they were added.
+def session_path(session_id):
+    return os.path.join(SESSION_DIR, re.sub(r'[^\w-]', '', str(session_id)) + '.json')
+
+def load_session(session_id):
+    try:
+        with open(session_path(session_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict(time={}, wvl={})
+
+def save_session(session_id, state):
+    write_atomic(session_path(session_id), lambda f: json.dump(state, f))
+
+# Session state for a read-modify-write, saved on exit. Callbacks of one tab
+# can run at once in different workers or threads, so the update holds an
+# exclusive lock on <session>.lock.
+@contextlib.contextmanager
+def edit_session(session_id):
+    path = session_path(session_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        state = load_session(session_id)
+        yield state
+        save_session(session_id, state)
+
+# Deletes session state and job statuses untouched for SESSION_MAX_AGE seconds
+def expire_state(max_age=SESSION_MAX_AGE):
+    cutoff = timer.time() - max_age
+    for directory in (SESSION_DIR, JOB_DIR):
+        for name in (os.listdir(directory) if os.path.isdir(directory) else []):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+def get_slices(session_id, kind):
+    return load_session(session_id)[kind]
+
+# Slices of a session including the last one drawn in the browser, which may
+# not have been saved yet when a graph is redrawn
+def known_slices(session_id, kind, client_slice):
+    slices = get_slices(session_id, kind)
+    if client_slice and client_slice['kind'] == kind:
+        slices.setdefault(client_slice['key'], client_slice['bounds'])
+    return slices
+
+def add_slice(session_id, kind, key, bounds):
+    with edit_session(session_id) as state:
+        state[kind][key] = bounds
+
+def clear_slices(session_id, kind):
+    with edit_session(session_id) as state:
+        state[kind] = {}
+
+# Block-reduces mean, min and max arrays along one axis by the given factor.
+# The last block may be shorter than the others. NaN cells are ignored.
+def reduce_blocks(mean, low, high, factor, axis):
+    if factor == 1:
+        return mean, low, high
+    starts = np.arange(0, mean.shape[axis], factor)
+    finite = np.isfinite(mean)
+    total = np.add.reduceat(np.where(finite, mean, 0), starts, axis=axis)
+    counts = np.add.reduceat(finite, starts, axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (total / counts).astype(np.float32)
+    low = np.fmin.reduceat(low, starts, axis=axis)
+    high = np.fmax.reduceat(high, starts, axis=axis)
+    return mean, low, high
+
+def reduce_axis(axis_values, factor):
+    if factor == 1:
+        return axis_values
+    starts = np.arange(0, len(axis_values), factor)
+    counts = np.diff(np.append(starts, len(axis_values)))
+    return np.add.reduceat(axis_values, starts) / counts
+
+# Decimation factors (delay, wavelength) of each pyramid level above level 0
+# for a dtt of the given shape. Each level is PYRAMID_FACTOR times coarser
+# along every axis still longer than HEATMAP_MAX_POINTS allows.
+def pyramid_factors(shape):
+    nt, nw = shape
+    max_t, max_w = HEATMAP_MAX_POINTS
+    factors = []
+    while nt > max_t or nw > max_w:
+        ft = PYRAMID_FACTOR if nt > max_t else 1
+        fw = PYRAMID_FACTOR if nw > max_w else 1
+        factors.append((ft, fw))
+        nt, nw = -(-nt // ft), -(-nw // fw)
+    return factors
+
+# Builds one pyramid level from the level below as float32 block mean/min/max
+# arrays. Level 1 is built by streaming row blocks off dtt (usually the file)
+# so the full matrix is never held in memory.
+def pyramid_level(prev, ft, fw):
+    if 'mean' in prev:
+        mean, low, high = reduce_blocks(prev['mean'], prev['min'],
+                                        prev['max'], ft, 0)
+        mean, low, high = reduce_blocks(mean, low, high, fw, 1)
+    else:
+        dtt = prev['dtt']
+        row_bytes = dtt.shape[1] * dtt.dtype.itemsize
+        step = max(1, PYRAMID_BLOCK_BYTES // (row_bytes * ft)) * ft
+        parts = []
+        for start in range(0, dtt.shape[0], step):
+            block = dtt[start:start + step, :].astype(np.float32)
+            parts.append(reduce_blocks(*reduce_blocks(
+                block, block, block, ft, 0), fw, 1))
+        mean, low, high = (np.concatenate(p) for p in zip(*parts))
+    return dict(time=reduce_axis(prev['time'], ft),
+                wavelength=reduce_axis(prev['wavelength'], fw),
+                mean=mean, min=low, max=high)
+
+# Decimation pyramid for a file. Level 0 is the full resolution LazyDTT
+# handle (or dtt if it is already mapped); the coarser levels are saved as
+# shared arrays so they are built once for all workers.
+@timed('pyramid')
+def get_pyramid(file_selection):
+    data = DATA[file_selection]
+    if 'pyramid' not in data.cache:
+        cached = data.loaded or shared_exists(data, 'dtt.npy')
+        source = data.dtt if cached else data.source
+        levels = [dict(time=data.time, wavelength=data.wavelength, dtt=source)]
+        settings = '_'.join(str(v) for v in HEATMAP_MAX_POINTS + (PYRAMID_FACTOR,))
+        for index, (ft, fw) in enumerate(pyramid_factors(source.shape), 1):
+            prev = levels[-1]
+            levels.append(shared_arrays(
+                data, 'pyramid' + str(index) + '_' + settings,
+                lambda: pyramid_level(prev, ft, fw)))
+        data.store('pyramid', levels)
+    return data.cache['pyramid']
+
+# Truncated SVD of a file's dtt: 'values' (rank), 'kinetics' (delay x rank)
+# and 'spectra' (wavelength x rank). NaNs are treated as zero.
+def svd_name(rank):
+    return 'svd' + '_'.join(str(v) for v in (rank, SVD_OVERSAMPLES, SVD_POWER_ITERATIONS))
+
+def get_svd(file_selection, rank=SVD_RANK):
+    data = DATA[file_selection]
+    key = ('svd', rank)
+    if key not in data.cache:
+        def build():
+            dtt = data.dtt
+            if not shared_array(data, 'finite', lambda: np.isfinite(dtt).all()):
+                dtt = np.nan_to_num(dtt)
+            u, s, vt = randomized_svd(dtt, rank)
+            return dict(values=s, kinetics=u, spectra=vt.T)
+        data.store(key, shared_arrays(data, svd_name(rank), build))
+    return data.cache[key]
+
+# Multi-exponential fits convolved with a Gaussian IRF. Lifetimes, t0 and the
+# IRF width are fitted by Levenberg-Marquardt on log(lifetimes), t0 and
+# log(sigma); the amplitudes are linear and solved exactly at every step
+# (variable projection). Everything is vectorized over wavelengths: a global
+# fit shares one set of nonlinear parameters across all traces, a per
+# wavelength fit runs one independent problem per trace in the same arrays.
+
+# Decays exp(-(t - t0) / tau) from t0, convolved with a Gaussian of standard
+# deviation sigma. tau (..., k) broadcasts against t0 and sigma (...) to give
+# (..., time, k). The erfcx form is used before t0 so nothing overflows.
+def exp_irf(time, tau, t0, sigma):
+    from scipy.special import erfc, erfcx
+    u = (time[:, None] - t0[..., None, None]) / sigma[..., None, None]
+    r = sigma[..., None, None] / tau[..., None, :]
+    z = (r - u) / np.sqrt(2)
+    with np.errstate(over='ignore', under='ignore'):
+        return np.where(z > 0, 0.5 * np.exp(-u**2 / 2) * erfcx(np.maximum(z, 0)),
+                        0.5 * np.exp(np.minimum(r * (r / 2 - u), 0)) * erfc(np.minimum(z, 0)))
+
+def fit_basis(time, theta):
+    k = theta.shape[-1] - 2
+    return exp_irf(time, np.exp(theta[..., :k]), theta[..., k], np.exp(theta[..., k + 1]))
+
+# Least-squares amplitudes (..., k, n) of bases (..., time, k) for traces
+# (..., time, n), through the normal equations of every batch at once
+def fit_amplitudes(basis, traces):
+    basis_t = np.swapaxes(basis, -1, -2)
+    gram = basis_t @ basis
+    ridge = 1e-12 * np.trace(gram, axis1=-2, axis2=-1)[..., None, None] + 1e-300
+    return np.linalg.solve(gram + ridge * np.eye(gram.shape[-1]), basis_t @ traces)
+
+# Residuals and amplitudes of a batch of fits. `weights` (0 or 1, shaped like
+# traces, whose masked points must be 0) leaves points out of each fit.
+def fit_residuals(time, theta, traces, weights=None):
+    basis = fit_basis(time, theta)
+    if weights is not None:
+        basis = basis * weights
+    amplitudes = fit_amplitudes(basis, traces)
+    return (traces - basis @ amplitudes).reshape(len(theta), -1), amplitudes
+
+# Levenberg-Marquardt over a batch of independent problems: theta is (batch,
+# params) and residuals(theta) returns (batch, points). The Jacobian is taken
+# by forward differences, one residual call per parameter for the whole batch,
+# and every problem keeps its own damping and stops on its own. Parameters are
+# kept within [lower, upper].
+def batched_lm(residuals, theta, lower, upper, max_iterations=FIT_MAX_ITERATIONS,
+               tol=1e-6):
+    theta = np.clip(np.array(theta, dtype=np.float64), lower, upper)
+    eye = np.eye(theta.shape[1])
+    r = residuals(theta)
+    cost = (r**2).sum(axis=1)
+    damping = np.full(len(theta), 1e-3)
+    active = np.isfinite(cost)
+    moved = True
+    for _ in range(max_iterations):
+        if not active.any():
+            break
+        if moved:
+            # The Jacobian only changes once some problem has taken a step
+            step = 1e-6 * np.maximum(np.abs(theta), 1)
+            jac = np.stack([(residuals(theta + step[:, [i]] * eye[i]) - r) / step[:, [i]]
+                            for i in range(theta.shape[1])], axis=2)
+            jac_t = np.swapaxes(jac, 1, 2)
+            jtj = jac_t @ jac
+            gradient = jac_t @ r[:, :, None]
+            scale = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), 1e-12)
+        delta = np.linalg.solve(jtj + (damping[:, None] * scale)[:, :, None] * eye,
+                                -gradient)[:, :, 0]
+        trial = np.clip(theta + np.where(active[:, None], delta, 0), lower, upper)
+        r_trial = residuals(trial)
+        cost_trial = (r_trial**2).sum(axis=1)
+        better = active & (cost_trial < cost)
+        converged = better & (cost - cost_trial <= tol * cost)
+        theta[better] = trial[better]
+        r[better] = r_trial[better]
+        cost[better] = cost_trial[better]
+        moved = better.any()
+        damping = np.where(better, damping / 10, damping * 10)
+        active &= ~converged & (damping < 1e10)
+    return theta
+
+# Fits the traces (time x n) from the starting parameters theta0. With shared
+# lifetimes one global fit is made to all traces, otherwise each trace is
+# fitted on its own. Returns per-trace arrays with lifetimes in ascending order.
+# Traces without enough finite points (masked bands) get NaN results; of the
+# rest, a global fit uses the delays finite in all of them and a per-trace fit
+# each trace's own finite points.
+def fit_traces(time, traces, theta0, shared):
+    finite = np.isfinite(traces)
+    if shared:
+        columns = finite.any(axis=0)
+        rows = finite[:, columns].all(axis=1)
+    else:
+        columns = finite.sum(axis=0) > len(theta0)
+        rows = finite[:, columns].any(axis=1)
+    if not columns.any() or rows.sum() <= len(theta0):
+        raise ValueError('Not enough finite delay points to fit')
+    total = traces.shape[1]
+    time, traces, finite = time[rows], traces[rows][:, columns], finite[rows][:, columns]
+    traces = np.where(finite, traces, 0)
+    n = traces.shape[1]
+    k = len(theta0) - 2
+    # Lifetimes and IRF width within a wide range of the delay span, t0 inside it
+    span = np.log(np.ptp(time))
+    lower = np.array([span - 14] * k + [time.min(), span - 14])
+    upper = np.array([span + 7] * k + [time.max(), span])
+    if shared:
+        batch = traces[None]
+        weights = None
+        theta = theta0[None]
+    else:
+        batch = traces.T[:, :, None]
+        weights = finite.T[:, :, None].astype(np.float64)
+        theta = np.repeat(theta0[None], n, axis=0)
+    theta = batched_lm(lambda params: fit_residuals(time, params, batch, weights)[0],
+                       theta, lower, upper)
+    residual, amplitudes = fit_residuals(time, theta, batch, weights)
+    if shared:
+        theta = np.repeat(theta, n, axis=0)
+        amplitudes = amplitudes[0].T
+        residual = residual.reshape(len(time), n).T
+    else:
+        amplitudes = amplitudes[:, :, 0]
+    order = np.argsort(theta[:, :k], axis=1)
+    fit = dict(lifetimes=np.take_along_axis(np.exp(theta[:, :k]), order, axis=1),
+               amplitudes=np.take_along_axis(amplitudes, order, axis=1),
+               t0=theta[:, k], sigma=np.exp(theta[:, k + 1]),
+               rms=np.sqrt((residual**2).sum(axis=1) / finite.sum(axis=0)))
+    for field, values in fit.items():
+        fit[field] = np.full((total,) + values.shape[1:], np.nan)
+        fit[field][columns] = values
+    return fit
+
+# Fits a file's kinetics: every wavelength column of dtt, or the band
+# averages of the given wavelength slices. Results are saved per file under a
+# hash of the settings, so the same fit is never run twice; returns the name.
+def run_fit(file_selection, lifetimes, fwhm, t0, shared, bands=None):
+    data = DATA[file_selection]
+    settings = json.dumps([lifetimes, fwhm, t0, shared, bands, FIT_MAX_ITERATIONS])
+    name = 'fit_' + hashlib.sha1(settings.encode()).hexdigest()[:16]
+    def build():
+        traces = data.dtt if bands is None else kinetics(data, bands)
+        theta0 = np.concatenate([np.log(lifetimes), [t0, np.log(fwhm / 2.3548)]])
+        if shared or traces.shape[1] <= FIT_CHUNK_COLUMNS:
+            return fit_traces(data.time, np.asarray(traces, dtype=np.float64), theta0, shared)
+        chunks = [np.asarray(traces[:, i:i + FIT_CHUNK_COLUMNS], dtype=np.float64)
+                  for i in range(0, traces.shape[1], FIT_CHUNK_COLUMNS)]
+        fits = list(job_pool().map(fit_traces, repeat(data.time), chunks,
+                                   repeat(theta0), repeat(False)))
+        return {field: np.concatenate([fit[field] for fit in fits]) for field in fits[0]}
+    data.store(('fit', name), shared_arrays(data, name, build))
+    return name
+
+# Arrays of the fit described by `fit_result` (the fit-result store). It holds
+# the fit's settings as well as its name, so a fit whose saved arrays were
+# trimmed from the cache is run again.
+def get_fit(fit_result):
+    data = DATA[fit_result['file']]
+    name = fit_result['name']
+    if ('fit', name) not in data.cache:
+        run_fit(fit_result['file'], **fit_result['settings'])
+    return data.cache[('fit', name)]
+
+# Fitted curves (time x n) of the fit rows selected by `rows`
+def fit_curves(time, fit, rows):
+    basis = exp_irf(time, fit['lifetimes'][rows], fit['t0'][rows], fit['sigma'][rows])
+    return (basis @ fit['amplitudes'][rows][:, :, None])[:, :, 0].T
+
+# Index range of the axis values that fall inside [lo, hi], widened by
+# HEATMAP_MARGIN of its length on both sides so small pans need no new data
+def view_indices(axis_values, axis_range):
+    n = len(axis_values)
+    if axis_range is None:
+        return 0, n
+    lo, hi = min(axis_range), max(axis_range)
+    inside = np.flatnonzero((axis_values >= lo) & (axis_values <= hi))
+    if inside.size == 0:
+        start = int(np.argmin(np.abs(axis_values - lo)))
+        stop = int(np.argmin(np.abs(axis_values - hi)))
+        start, stop = min(start, stop), max(start, stop)
+    else:
+        start, stop = int(inside[0]), int(inside[-1])
+    pad = int((stop - start + 1) * HEATMAP_MARGIN)
+    return max(0, start - pad), min(n, stop + pad + 1)
+
+# Picks the finest pyramid level whose share of the viewport fits within
+# HEATMAP_MAX_POINTS. Returns the level index and its delay/wavelength crop.
+def choose_level(levels, view):
+    max_t, max_w = HEATMAP_MAX_POINTS
+    for index, level in enumerate(levels):
+        t0, t1 = view_indices(level['time'], view.get('x'))
+        w0, w1 = view_indices(level['wavelength'], view.get('y'))
+        if (t1 - t0 <= max_t and w1 - w0 <= max_w) or index == len(levels) - 1:
+            break
+    return index, t0, t1, w0, w1
+
+# Returns the cropped delay axis, wavelength axis and dtt block (time x
+# wavelength) to show for a view, along with a record of what was served
+@timed('heatmap view')
+def heatmap_view(file_selection, view):
+    levels = get_pyramid(file_selection)
+    index, t0, t1, w0, w1 = choose_level(levels, view)
+    level = levels[index]
+    time = level['time'][t0:t1]
+    wavelength = level['wavelength'][w0:w1]
+    if 'mean' not in level:
+        z = level['dtt'][t0:t1, w0:w1]
+    elif HEATMAP_REDUCTION == 'extrema':
+        mean = level['mean'][t0:t1, w0:w1]
+        low = level['min'][t0:t1, w0:w1]
+        high = level['max'][t0:t1, w0:w1]
+        z = np.where(high - mean >= mean - low, high, low)
+    else:
+        z = level['mean'][t0:t1, w0:w1]
+    served = dict(level=index,
+                  x=[float(time.min()), float(time.max())] if len(time) else None,
+                  y=[float(wavelength.min()), float(wavelength.max())] if len(wavelength) else None,
+                  full=[t0 == 0 and t1 == len(level['time']),
+                        w0 == 0 and w1 == len(level['wavelength'])])
+    return time, wavelength, z, served
+
+# Reads the visible axis ranges (in data units) out of a zoom/pan
+# relayoutData event. Returns None if the event carries no range change.
+def relayout_view(relayoutData, view, x_type, y_type):
+    view = dict(view)
+    changed = False
+    for key, axis, axis_type in (('x', 'xaxis', x_type), ('y', 'yaxis', y_type)):
+        if relayoutData.get(axis + '.autorange'):
+            view[key] = None
+            changed = True
+            continue
+        if axis + '.range' in relayoutData:
+            axis_range = list(relayoutData[axis + '.range'])
+        elif axis + '.range[0]' in relayoutData:
+            axis_range = [relayoutData[axis + '.range[0]'],
+                          relayoutData[axis + '.range[1]']]
+        else:
+            continue
+        if axis_type == 'log':
+            axis_range = [10**v for v in axis_range]
+        view[key] = axis_range
+        changed = True
+    return view if changed else None
+
+# Packs an array as a plotly.js typed array spec ({dtype, bdata, shape}) so
+# it is sent as base64 instead of a nested list of floats
+def pack_array(array, dtype=np.float32):
+    array = np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder('<'))
+    packed = dict(dtype=array.dtype.str[1:],
+                  bdata=base64.b64encode(array.tobytes()).decode('ascii'))
+    if array.ndim > 1:
+        packed['shape'] = ','.join(str(n) for n in array.shape)
+    return packed
+
+# Minimal RGBA PNG encoder (no filtering, zlib compressed)
+def png_bytes(rgba):
+    height, width = rgba.shape[:2]
+    def chunk(kind, payload):
+        return (struct.pack('>I', len(payload)) + kind + payload
+                + struct.pack('>I', zlib.crc32(kind + payload) & 0xffffffff))
+    rows = np.concatenate([np.zeros((height, 1), np.uint8),
+                           rgba.reshape(height, width * 4)], axis=1)
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows.tobytes(), 6))
+            + chunk(b'IEND', b''))
+
+# Maps values onto the RdBu colour scale between zmin and zmax. NaN cells
+# are left transparent.
+def colour_map(z, zmin, zmax):
+    stops = np.array([plotly.colors.unlabel_rgb(c) for c in plotly.colors.diverging.RdBu])
+    positions = np.linspace(0, 1, len(stops))
+    scaled = np.nan_to_num(np.clip((z - zmin) / ((zmax - zmin) or 1), 0, 1))
+    rgba = np.empty(z.shape + (4,), dtype=np.uint8)
+    for channel in range(3):
+        rgba[..., channel] = np.interp(scaled, positions, stops[:, channel])
+    rgba[..., 3] = np.where(np.isfinite(z), 255, 0)
+    return rgba
+
+# Resamples a (time x wavelength) block onto a uniform pixel grid in axis
+# space (log10 for log axes) and renders it as a layout image spanning the
+# block on the graph's axes
+def heatmap_image(time, wavelength, dtt, zmin, zmax, x_type, y_type):
+    keep_t = time > 0 if x_type == 'log' else np.ones(len(time), bool)
+    keep_w = wavelength > 0 if y_type == 'log' else np.ones(len(wavelength), bool)
+    xs = np.log10(time[keep_t]) if x_type == 'log' else time[keep_t]
+    ys = np.log10(wavelength[keep_w]) if y_type == 'log' else wavelength[keep_w]
+    if len(xs) == 0 or len(ys) == 0:
+        return None
+    block = dtt[keep_t][:, keep_w]
+    width = int(min(HEATMAP_MAX_POINTS[0], 4 * len(xs)))
+    height = int(min(HEATMAP_MAX_POINTS[1], 4 * len(ys)))
+    x_lo, x_hi, y_lo, y_hi = (float(v) for v in (xs.min(), xs.max(), ys.min(), ys.max()))
+    columns = closest_indices(xs, np.linspace(x_lo, x_hi, width))
+    rows = closest_indices(ys, np.linspace(y_hi, y_lo, height))
+    rgba = colour_map(block[np.ix_(columns, rows)].T, zmin, zmax)
+    dx = (x_hi - x_lo) / max(width - 1, 1)
+    dy = (y_hi - y_lo) / max(height - 1, 1)
+    source = 'data:image/png;base64,' + base64.b64encode(png_bytes(rgba)).decode('ascii')
+    return dict(source=source, xref='x', yref='y', x=x_lo - dx / 2, y=y_hi + dy / 2,
+                sizex=x_hi - x_lo + dx, sizey=y_hi - y_lo + dy, sizing='stretch',
+                xanchor='left', yanchor='top', layer='below')
+
+# Heatmap trace properties and layout properties that carry a (time x
+# wavelength) block to the browser in the given transport mode
+@timed('heatmap payload')
+def heatmap_payload(time, wavelength, dtt, transport, x_type, y_type):
+    z = dtt.transpose()
+    if transport == 'json':
+        return dict(x=time, y=wavelength, z=z), dict()
+    elif transport == 'binary':
+        return dict(x=pack_array(time, np.float64), y=pack_array(wavelength, np.float64),
+                    z=pack_array(z)), dict()
+    finite = np.isfinite(dtt)
+    zmin = float(dtt[finite].min()) if finite.any() else 0
+    zmax = float(dtt[finite].max()) if finite.any() else 1
+    step_t = -(-len(time) // HOVER_MAX_POINTS[0])
+    step_w = -(-len(wavelength) // HOVER_MAX_POINTS[1])
+    image = heatmap_image(time, wavelength, dtt, zmin, zmax, x_type, y_type)
+    trace = dict(x=pack_array(time[::step_t], np.float64),
+                 y=pack_array(wavelength[::step_w], np.float64),
+                 z=pack_array(z[::step_w, ::step_t]), opacity=0)
+    layout = dict(images=[image] if image else [],
+                  coloraxis=dict(cmin=zmin, cmax=zmax))
+    return trace, layout
+
+# Size in bytes of a heatmap payload once serialized
+def payload_size(trace, layout):
+    return len(json.dumps(dict(trace, **layout), cls=PlotlyJSONEncoder))
+
+def payload_note(size, seconds, transport):
+    return ('Heatmap ' + transport + ': ' + str(round(size / 1024)) + ' kB, built in '
+            + str(round(seconds * 1000)) + ' ms')
+
+# Writes the heatmap block for a view into a dash.Patch of ta-graph and
+# records what was served in the view. Returns the payload note.
+def patch_heatmap(patch, file_selection, view, x_type, y_type):
+    start = timer.perf_counter()
+    transport = view.get('transport', HEATMAP_TRANSPORT)
+    time, wavelength, dtt, view['served'] = heatmap_view(file_selection, view)
+    trace, layout = heatmap_payload(time, wavelength, dtt, transport, x_type, y_type)
+    for key, value in trace.items():
+        patch['data'][0][key] = value
+    for key, value in layout.items():
+        patch['layout'][key] = value
+    return payload_note(payload_size(trace, layout), timer.perf_counter() - start,
+                        transport)
+
+# True if the data already on the graph covers the requested view at the
+# level that view would be served at, so no new heatmap needs to be sent
+def view_is_served(file_selection, view):
+    served = view.get('served')
+    if not served:
+        return False
+    index = choose_level(get_pyramid(file_selection), view)[0]
+    if index != served['level']:
+        return False
+    for key, full in zip(('x', 'y'), served['full']):
+        wanted = view.get(key)
+        if full:
+            continue
+        if wanted is None or served[key] is None:
+            return False
+        if min(wanted) < served[key][0] or max(wanted) > served[key][1]:
+            return False
+    return True
+
 # Adds time slice from rectangle dragged over graph
-def graph_time_slice(relayoutData, time_clicks, file_selection):
-    timescale = DATA.loc['timescale', file_selection]
+def graph_time_slice(relayoutData, time_clicks, file_selection, session_id):
+    timescale = DATA[file_selection].timescale
     x0 = relayoutData['shapes'][-1]['x0']
     x1 = relayoutData['shapes'][-1]['x1']
     if x0 > x1:
@@ -268,12 +2490,12 @@ def graph_time_slice(relayoutData, time_clicks, file_selection):
         x_min = x0
         x_max = x1
     key = str(round(x_min)) + ' ' + timescale + ' - ' + str(round(x_max)) + ' ' + timescale
-    TIME_SLICES[key] = [x_min, x_max]
-    return time_clicks + 1, TIME_SLICES
+    add_slice(session_id, 'time', key, [x_min, x_max])
+    return time_clicks + 1
 
 
 
-def graph_wvl_slice(relayoutData, wvl_clicks):
+def graph_wvl_slice(relayoutData, wvl_clicks, session_id):
     y0 = relayoutData['shapes'][-1]['y0']
     y1 = relayoutData['shapes'][-1]['y1']
     if y0 > y1:
@@ -283,8 +2505,8 @@ def graph_wvl_slice(relayoutData, wvl_clicks):
         y_min = y0
         y_max = y1
     key = str(round(y_min)) + ' nm - ' + str(round(y_max)) + ' nm'
-    WVL_SLICES[key] = [y_min, y_max]
-    return wvl_clicks + 1, WVL_SLICES
+    add_slice(session_id, 'wvl', key, [y_min, y_max])
+    return wvl_clicks + 1
 
 def update_axes(fig, x_type, x_min, x_max, y_type, y_min, y_max):
     if x_type == 'log':
@@ -304,32 +2526,315 @@ def update_axes(fig, x_type, x_min, x_max, y_type, y_min, y_max):
         if y_min != None and y_max != None:
             fig.update_yaxes(range=[y_min, y_max])
     return fig
-    
+
+# Same axis settings as update_axes, written into a dash.Patch so only the
+# layout properties are sent to the browser
+def patch_axes(patch, x_type, x_min, x_max, y_type, y_min, y_max):
+    for axis, axis_type, lo, hi in (('xaxis', x_type, x_min, x_max),
+                                    ('yaxis', y_type, y_min, y_max)):
+        patch['layout'][axis]['type'] = axis_type
+        if lo != None and hi != None:
+            if axis_type == 'log':
+                lo, hi = math.log(lo, 10), math.log(hi, 10)
+            patch['layout'][axis]['range'] = [lo, hi]
+            patch['layout'][axis]['autorange'] = False
+        else:
+            patch['layout'][axis]['autorange'] = True
+    return patch
+
+# Shape drawing settings for the heatmap: vertical bands pick time slices,
+# horizontal bands pick wavelength slices
+def shape_layout(time_switch_val):
+    direction = 'vertical' if time_switch_val else 'horizontal'
+    return dict(clickmode='event+select', 
+                dragmode='drawrect',
+                modebar_add = ['drawrect', 'eraseshape'], 
+                newshape = dict(drawdirection=direction, 
+                                fillcolor='red', line_width=0))
+
+# Line trace for one slice. Colours follow the trace's position on the graph.
+# `error` adds error bars.
+def slice_trace(x, y, name, index, error=None):
+    colors = plotly.colors.qualitative.Pastel
+    trace = dict(type='scatter', mode='lines', x=x, y=y, name=name,
+                 line=dict(color=colors[index % len(colors)]))
+    if error is not None:
+        trace['error_y'] = dict(type='data', array=error, thickness=1, width=0,
+                                color=colors[index % len(colors)])
+    return trace
+
+# Full kinetics/spectra figure, one trace per column of `traces` (with error
+# bars from the matching column of `errors`, if given)
+@timed('slice figure')
+def slice_figure(x, traces, keys, x_title, errors=None, quantity=QUANTITIES['ta']):
+    fig = go.Figure(layout=dict(template=standard_template))
+    for index, key in enumerate(keys):
+        fig.add_trace(slice_trace(x, traces[:, index], key, index,
+                                  None if errors is None else errors[:, index]))
+    fig.update_layout(showlegend=True,
+                      legend_x=1,
+                      legend_xanchor='right',
+                      legend_title_text = '',
+                      xaxis=dict(title_text = x_title),
+                      yaxis=dict(title_text='<b>' + quantity + '</b>'))
+    return fig
+
+# Singular value plot (log scale) for the SVD graphs
+def svd_values_figure(values, shown):
+    colors = plotly.colors.qualitative.Pastel
+    index = np.arange(1, len(values) + 1)
+    fig = go.Figure(layout=dict(template=standard_template))
+    fig.add_trace(dict(type='scatter', mode='markers', x=index, y=values,
+                       marker=dict(color=[colors[(i - 1) % len(colors)] if i <= shown
+                                          else 'lightgrey' for i in index])))
+    fig.update_layout(showlegend=False,
+                      xaxis=dict(title_text='<b>Component</b>'),
+                      yaxis=dict(title_text='<b>Singular value</b>', type='log'))
+    return fig
+
+# Brings a kinetics/spectra graph showing `shown` (the file and slice keys it
+# was drawn with) up to date with the selected slice keys. Removed slices are
+# deleted and new ones appended through a dash.Patch, so only the new traces
+# are computed and sent. `compute` returns the traces for a list of keys and
+# `errors`, if given, their error bars (or None).
+def patch_slice_figure(shown, keys, x, compute, errors=lambda keys: None):
+    patch = dash.Patch()
+    current = list(shown['keys'])
+    removed = [i for i, key in enumerate(current) if key not in keys]
+    for index in reversed(removed):
+        del patch['data'][index]
+    current = [key for key in current if key in keys]
+    if removed:
+        # Recolour the remaining traces so they keep matching a full redraw
+        colors = plotly.colors.qualitative.Pastel
+        for index in range(len(current)):
+            patch['data'][index]['line']['color'] = colors[index % len(colors)]
+            patch['data'][index]['error_y']['color'] = colors[index % len(colors)]
+    added = [key for key in keys if key not in current]
+    if added:
+        traces = compute(added)
+        bars = errors(added)
+        for offset, key in enumerate(added):
+            patch['data'].append(slice_trace(x, traces[:, offset], key,
+                                             len(current) + offset,
+                                             None if bars is None else bars[:, offset]))
+    return patch, dict(shown, keys=current + added)
         
 # All functions with @app.callback decorator return an updated output to the
 # Dash components labeled in the first lines. Only one function can output to
 # a given component.
 
 
+# Uploaded files are imported by background jobs. While any are pending the
+# job-poll interval runs and the progress bar shows their average progress;
+# each file is added to the dropdown once its job is done, and the dropdown
+# switches to the last file of the batch when the whole batch is ready.
 @app.callback(
     Output("file-dropdown", "options"),
     Output("file-dropdown", "value"),
-    Input('file-load', 'contents'),
+    Output('pending-jobs', 'data'),
+    Output('job-poll', 'disabled'),
+    Output('job-progress', 'value'),
+    Output('job-status', 'children'),
+    Output('job-display', 'style'),
+    Input('file-load', 'data'),
     Input('file-delete', 'n_clicks'),
-    State('file-load', 'filename'),
+    Input('job-poll', 'n_intervals'),
     State("file-dropdown", "options"),
     State('file-dropdown', 'value'),
+    State('pending-jobs', 'data'),
     prevent_initial_call=True)
-def update_file_dropdown(contents, delete_clicks, filename, options, value):
-    global DATA
+def update_file_dropdown(uploaded, delete_clicks, n_intervals, options, value, pending):
     ctx = dash.callback_context #Identifies which input triggered callback
     switch_id = ctx.triggered[0]['prop_id'].split('.')[0]
+    pending = list(pending or [])
     if switch_id == 'file-delete':
         options, value = delete_data(options, value)
-        return options, value
-    else:
-        options = import_data(options, filename) 
-        return options, filename
+        return options, value, no_update, no_update, no_update, no_update, no_update
+    elif switch_id == 'file-load':
+        if not uploaded or not uploaded['files']:
+            raise PreventUpdate
+        pending += [submit_import(entry['path'], entry['name'])
+                    for entry in uploaded['files'] if allowed_file(entry['path'])]
+    statuses = [read_job(job_id) for job_id in pending]
+    messages = []
+    value = no_update
+    for status in statuses:
+        if status['state'] == 'done':
+            options = import_data(options, status['path'], status['name'])
+        elif status['state'] == 'error':
+            messages.append(status['message'])
+    remaining = [job_id for job_id, status in zip(pending, statuses)
+                 if status['state'] not in ('done', 'error')]
+    if not remaining:
+        for job_id in pending:
+            remove_job(job_id)
+        done = [status['path'] for status in statuses if status['state'] == 'done']
+        if done:
+            value = done[-1]
+        display = {'display': 'block'} if messages else {'display': 'none'}
+        return options, value, [], True, 100, ' '.join(messages), display
+    progress = 100 * sum(status['progress'] for status in statuses) / len(statuses)
+    running = [status['message'] for status in statuses if status['state'] == 'running']
+    message = (running[0] if running else statuses[0]['message'])
+    if len(remaining) > 1:
+        message += ' (' + str(len(remaining)) + ' files left)'
+    return (options, value, pending, False, progress,
+            ' '.join(messages + [message]), {'display': 'block'})
+
+# Watch mode: adds files that appeared in WATCH_DIR to the list and reads the
+# scans appended to the files being acquired. 'live-scans' maps every file seen
+# to its complete scan count (None if it isn't being acquired), so a file
+# removed from the list is not added again; a change of count redraws the
+# views through update_data_selection.
+@app.callback(
+    Output('file-dropdown', 'options', allow_duplicate=True),
+    Output('live-scans', 'data'),
+    Input('watch-poll', 'n_intervals'),
+    State('file-dropdown', 'options'),
+    State('live-scans', 'data'),
+    prevent_initial_call=True)
+def watch_folder(n_intervals, options, seen):
+    options = dict(options or {})
+    previous = seen or {}
+    seen = dict(previous)
+    added = False
+    for path in watched_files():
+        live = is_live(path)
+        if path not in seen:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if UNREADABLE.get(path) == (stat.st_mtime_ns, stat.st_size):
+                continue
+            try:
+                if live:
+                    options[path] = os.path.basename(path) + ' (live)'
+                else:
+                    import_data(options, path, os.path.basename(path))
+            except (OSError, KeyError, ValueError):
+                UNREADABLE[path] = (stat.st_mtime_ns, stat.st_size)
+                continue
+            seen[path] = None
+            added = True
+        if live:
+            try:
+                seen[path] = update_live(path)['scans']
+            except (OSError, KeyError, ValueError):
+                pass
+    return options if added else no_update, seen if seen != previous else no_update
+
+# Preprocessing pipeline from the sidebar inputs, as [[stage, params], ...] in
+# PIPELINE_STAGES order. Bad-pixel bands are given as 'min-max' (either end
+# may be left open) or a single wavelength, separated by commas.
+def pipeline_from_inputs(scan_average, exclude, background_before, chirp_coefficients,
+                         chirp_reference, mask_threshold, mask_bands, smooth_time,
+                         smooth_wvl, rebin_mode, rebin_points, rebin_linear):
+    pipeline = []
+    if scan_average not in (None, 'file'):
+        pipeline.append(['average', dict(method=scan_average, exclude=exclude)])
+    if background_before != None:
+        pipeline.append(['background', dict(before=background_before)])
+    if chirp_coefficients:
+        coefficients = [float(v) for v in re.split(r'[,;\s]+', chirp_coefficients) if v]
+        pipeline.append(['chirp', dict(coefficients=coefficients,
+                                       reference=chirp_reference or 0)])
+    bands = []
+    for band in (mask_bands or '').split(','):
+        if band.strip():
+            lo, sep, hi = band.partition('-')
+            lo = float(lo) if lo.strip() else None
+            hi = (float(hi) if hi.strip() else None) if sep else lo
+            bands.append([lo, hi])
+    if mask_threshold != None or bands:
+        pipeline.append(['mask', dict(threshold=mask_threshold, bands=bands)])
+    if (smooth_time or 1) > 1 or (smooth_wvl or 1) > 1:
+        pipeline.append(['smooth', dict(time_points=int(smooth_time or 1),
+                                        wavelength_points=int(smooth_wvl or 1))])
+    if rebin_mode not in (None, 'none') and rebin_points:
+        if rebin_mode == 'linlog' and not (rebin_linear or 0) > 0:
+            raise ValueError('lin-log rebinning needs the delay where it turns logarithmic')
+        pipeline.append(['rebin', dict(mode=rebin_mode, points=int(rebin_points),
+                                       threshold=rebin_linear if rebin_mode == 'linlog' else None)])
+    return pipeline
+
+# Sets the data every view reads: the selected file seen through the
+# preprocessing stages. The stages run here, in order, so the views only map
+# finished arrays; stages saved by an earlier pipeline are reused.
+@app.callback(
+    Output('data-selection', 'data'),
+    Output('pipeline-status', 'children'),
+    Input('file-dropdown', 'value'),
+    Input('scan-average', 'value'),
+    Input('scan-drop-outliers', 'value'),
+    Input('background-before', 'value'),
+    Input('chirp-coefficients', 'value'),
+    Input('chirp-reference', 'value'),
+    Input('mask-threshold', 'value'),
+    Input('mask-bands', 'value'),
+    Input('smooth-time', 'value'),
+    Input('smooth-wvl', 'value'),
+    Input('rebin-mode', 'value'),
+    Input('rebin-points', 'value'),
+    Input('rebin-linear', 'value'),
+    Input('live-scans', 'data'),
+    State('data-selection', 'data'))
+def update_data_selection(file_selection, scan_average, drop_outliers, *pipeline_inputs):
+    ctx = dash.callback_context
+    switch_id = ctx.triggered[0]['prop_id'].split('.')[0]
+    *pipeline_inputs, live_scans, shown = pipeline_inputs
+    if file_selection == None:
+        return None, ''
+    live = is_live(file_selection)
+    if switch_id == 'live-scans' and not (
+            live and (live_scans or {}).get(file_selection) != None and
+            selection_scans(shown) != live_scans[file_selection]):
+        raise PreventUpdate
+    status = []
+    if live:
+        try:
+            file_selection = live_selection(file_selection)
+        except (OSError, ValueError) as e:
+            return no_update, str(e)
+        status.append(file_selection.rpartition('@')[2] + ' scans averaged')
+        path = file_selection.rpartition('@')[0]
+        for name in DATA:
+            if name.startswith(path + '@') and not (
+                    name == file_selection or name.startswith(file_selection + '#')):
+                shutil.rmtree(cache_dir(DATA[name]), ignore_errors=True)
+                DATA.remove(name)
+    exclude = []
+    if scan_average not in (None, 'file'):
+        data = DATA[file_selection]
+        if data.scans == 0:
+            return no_update, 'This file holds no individual scans'
+        outliers = np.flatnonzero(scan_statistics(data)['outlier']).tolist()
+        status.append(str(data.scans) + ' scans' + (
+            ', outliers: ' + ', '.join(str(i + 1) for i in outliers) if outliers else ''))
+        if drop_outliers:
+            exclude = outliers
+    try:
+        pipeline = pipeline_from_inputs(scan_average, exclude, *pipeline_inputs)
+    except ValueError:
+        return no_update, 'Could not read the preprocessing settings'
+    selection = pipeline_selection(file_selection, pipeline)
+    stages = []
+    data = DATA[selection]
+    while isinstance(data, ProcessedDataset):
+        stages.insert(0, data)
+        data = data.parent
+    for data in stages:
+        saved = shared_exists(data, 'dtt.npy')
+        start = timer.perf_counter()
+        try:
+            data.dtt
+        except ValueError as e:
+            DATA.remove(selection)
+            return no_update, str(e)
+        status.append(data.stage + (' (saved)' if saved else
+                                    ' ' + str(round(timer.perf_counter() - start, 2)) + ' s'))
+    return selection, ', '.join(status)
 
 # Toggles slicing switches so that only one is activated at any time
 @app.callback(
@@ -360,15 +2865,18 @@ def toggle_time_switch(time_switch_val, wvl_switch_val):
     Input('time-from-clear', 'n_clicks'),
     State('time-dropdown', 'options'),
     State('time-dropdown', 'value'),
+    State('session-id', 'data'),
     prevent_initial_call=True)
-def update_time_dropdown(graph_clicks, input_clicks, clear_clicks, options, value):
+def update_time_dropdown(graph_clicks, input_clicks, clear_clicks, options, value,
+                         session_id):
     ctx = dash.callback_context
     switch_id = ctx.triggered[0]['prop_id'].split('.')[0]
-    if TIME_SLICES.empty:
+    slices = get_slices(session_id, 'time')
+    if not slices and switch_id != 'time-from-clear':
         raise PreventUpdate
     elif switch_id == 'time-from-graph' or switch_id == 'time-from-input':
-        options.append(TIME_SLICES.columns[-1])
-        value.append(TIME_SLICES.columns[-1])
+        options.append(list(slices)[-1])
+        value.append(list(slices)[-1])
         return options, value
     else: # Must have been triggered by clear button
         return [], []
@@ -382,21 +2890,24 @@ def update_time_dropdown(graph_clicks, input_clicks, clear_clicks, options, valu
     Input('wvl-from-clear', 'n_clicks'),
     State('wvl-dropdown', 'options'),
     State('wvl-dropdown', 'value'),
+    State('session-id', 'data'),
     prevent_initial_call=True)
-def update_wvl_dropdown(graph_clicks, input_clicks, clear_clicks, options, value):
+def update_wvl_dropdown(graph_clicks, input_clicks, clear_clicks, options, value,
+                         session_id):
     ctx = dash.callback_context
     switch_id = ctx.triggered[0]['prop_id'].split('.')[0]
-    if WVL_SLICES.empty:
+    slices = get_slices(session_id, 'wvl')
+    if not slices and switch_id != 'wvl-from-clear':
         raise PreventUpdate
     elif switch_id == 'wvl-from-graph' or switch_id == 'wvl-from-input':
-        options.append(WVL_SLICES.columns[-1])
-        value.append(WVL_SLICES.columns[-1])
+        options.append(list(slices)[-1])
+        value.append(list(slices)[-1])
         return options, value
     else: # Must have been triggered by clear button
         return [], []
 
-# Stores input from box to TIME_SLICES. Output triggers dropdown function
-# to update the display
+# Stores input from box to the session's time slices. Output triggers
+# dropdown function to update the display
 @app.callback(
     Output('time-from-input', 'n_clicks'),
     Input('add-time-slice', 'n_clicks'),
@@ -404,56 +2915,45 @@ def update_wvl_dropdown(graph_clicks, input_clicks, clear_clicks, options, value
     State('time-max', 'value'),
     State('time-from-input', 'n_clicks'),
     State('file-dropdown', 'value'),
+    State('session-id', 'data'),
     prevent_initial_call=True)
-def add_time_from_input(add_clicks, time_min, time_max, input_clicks, file_selection):
-    global TIME_SLICES
-    timescale = DATA.loc['timescale', file_selection]
-    if time_max == None:
-        key = str(time_min) + ' ' + timescale
-    elif time_min == None:
-        key = str(time_max) + ' ' + timescale
-    else: 
-        key = str(time_min) + ' ' + timescale + ' - ' + str(time_max) + ' ' + timescale
-    
-    TIME_SLICES[key] = ([time_min, time_max])
+def add_time_from_input(add_clicks, time_min, time_max, input_clicks, file_selection,
+                        session_id):
+    key = slice_key(time_min, time_max, DATA[file_selection].timescale)
+    add_slice(session_id, 'time', key, [time_min, time_max])
     return input_clicks + 1
 
-# Stores input from box to WVL_SLICES. Output triggers dropdown function
-# to update the display
+# Stores input from box to the session's wavelength slices. Output triggers
+# dropdown function to update the display
 @app.callback(
     Output('wvl-from-input', 'n_clicks'),
     Input('add-wvl-slice', 'n_clicks'),
     State('wvl-min', 'value'),
     State('wvl-max', 'value'),
     State('wvl-from-input', 'n_clicks'),
+    State('session-id', 'data'),
     prevent_initial_call=True)
-def add_wvl_from_input(add_clicks, wvl_min, wvl_max, input_clicks):
-    global WVL_SLICES
-    if wvl_max == None:
-        key = str(wvl_min) + ' nm'
-    elif wvl_min == None:
-        key = str(wvl_max) + ' nm'
-    else: 
-        key = str(wvl_min) + ' nm - ' + str(wvl_max) + ' nm'
-    WVL_SLICES[key] = ([wvl_min, wvl_max])
+def add_wvl_from_input(add_clicks, wvl_min, wvl_max, input_clicks, session_id):
+    key = slice_key(wvl_min, wvl_max, 'nm')
+    add_slice(session_id, 'wvl', key, [wvl_min, wvl_max])
     return input_clicks + 1
 
 @app.callback(
     Output('time-from-clear', 'n_clicks'),
     Input('clear-time-slice', 'n_clicks'),
-    State('time-from-clear', 'n_clicks'))
-def clear_time_slices(clear_button_clicks, clear_time_clicks):
-    global TIME_SLICES
-    TIME_SLICES = pd.DataFrame()
+    State('time-from-clear', 'n_clicks'),
+    State('session-id', 'data'))
+def clear_time_slices(clear_button_clicks, clear_time_clicks, session_id):
+    clear_slices(session_id, 'time')
     return clear_time_clicks + 1
 
 @app.callback(
     Output('wvl-from-clear', 'n_clicks'),
     Input('clear-wvl-slice', 'n_clicks'),
-    State('wvl-from-clear', 'n_clicks'))
-def clear_wvl_slices(clear_button_clicks, clear_wvl_clicks):
-    global WVL_SLICES
-    WVL_SLICES = pd.DataFrame()
+    State('wvl-from-clear', 'n_clicks'),
+    State('session-id', 'data'))
+def clear_wvl_slices(clear_button_clicks, clear_wvl_clicks, session_id):
+    clear_slices(session_id, 'wvl')
     return clear_wvl_clicks + 1
 
 # Single function responsible for updating the main TA data figure. 
@@ -462,7 +2962,9 @@ def clear_wvl_slices(clear_button_clicks, clear_wvl_clicks):
     Output('ta-graph', 'figure'),
     Output('time-from-graph', 'n_clicks'),
     Output('wvl-from-graph', 'n_clicks'),
-    Input('file-dropdown', 'value'),
+    Output('ta-view', 'data'),
+    Output('ta-payload', 'children'),
+    Input('data-selection', 'data'),
     Input('time-switch', 'value'),
     Input('ta-graph', 'relayoutData'),
     Input('x-axis-type', 'value'),
@@ -471,59 +2973,269 @@ def clear_wvl_slices(clear_button_clicks, clear_wvl_clicks):
     Input('y-axis-type', 'value'),
     Input('y-axis-min', 'value'),
     Input('y-axis-max', 'value'),
+    Input('transport-type', 'value'),
     State('time-from-graph', 'n_clicks'),
     State('wvl-from-graph', 'n_clicks'),
+    State('ta-view', 'data'),
+    State('session-id', 'data'),
+    State('client-slicing', 'value'),
     prevent_initial_call=True)
 def update_ta_graph(file_selection, time_switch_val, relayoutData, 
-                    x_type, x_min, x_max, y_type, y_min, y_max, 
-                    time_clicks, wvl_clicks):
-    global TIME_SLICES
-    global WVL_SLICES
+                    x_type, x_min, x_max, y_type, y_min, y_max, transport,
+                    time_clicks, wvl_clicks, view, session_id, client_slicing):
     ctx = dash.callback_context
     switch_id = ctx.triggered[0]['prop_id'].split('.')[0]
-    if DATA.empty or file_selection == None :
+    view = dict(view or {})
+    if file_selection == None :
         raise PreventUpdate
     elif switch_id == 'ta-graph':
         if 'shapes' not in relayoutData:
-            raise PreventUpdate()
+            # Zoom/pan: only send a new heatmap if the view needs another
+            # pyramid level or runs past the block already on the graph
+            new_view = relayout_view(relayoutData, view, x_type, y_type)
+            if new_view is None or view_is_served(file_selection, new_view):
+                raise PreventUpdate()
+            patch = dash.Patch()
+            note = patch_heatmap(patch, file_selection, new_view, x_type, y_type)
+            return patch, no_update, no_update, new_view, note
+        # The new shape is already drawn in the browser, so the figure
+        # itself is left alone. In client mode the browser slices it too.
+        elif client_slicing:
+            raise PreventUpdate
         elif time_switch_val:
-            time_clicks, TIME_SLICES = graph_time_slice(relayoutData, 
-                                                        time_clicks, 
-                                                        file_selection) 
-            wvl_clicks = no_update
+            time_clicks = graph_time_slice(relayoutData, time_clicks,
+                                           file_selection, session_id)
+            return no_update, time_clicks, no_update, no_update, no_update
         else:
-            wvl_clicks, WVL_SLICES = graph_wvl_slice(relayoutData, 
-                                                     wvl_clicks)
-            time_clicks = no_update                
-    timescale = DATA.loc['timescale', file_selection]   
-    fig = px.imshow(DATA.loc['dtt', file_selection].transpose(),
-                    labels=dict(x='<b>Delay Time (' + timescale + ')</b>', 
-                                y='<b>Wavelength (nm)</b>', 
-                                color= '<b>\u0394'+ 'T/T</b>'),
-                    x = DATA.loc['time', file_selection],
-                    y = DATA.loc['wavelength', file_selection],
-                    aspect='auto', origin='lower', template = standard_template,
-                    color_continuous_scale=px.colors.diverging.RdBu)
+            wvl_clicks = graph_wvl_slice(relayoutData, wvl_clicks, session_id)
+            return no_update, no_update, wvl_clicks, no_update, no_update
+    elif (switch_id not in ('data-selection', 'transport-type')
+            and view.get('file') == file_selection):
+        # Layout-only changes are sent as a patch. Typing an axis range may
+        # also need a different block of the heatmap, and a server-rendered
+        # image has to be redrawn when an axis changes between linear and log.
+        patch = dash.Patch()
+        if switch_id == 'time-switch':
+            patch['layout']['newshape']['drawdirection'] = (
+                shape_layout(time_switch_val)['newshape']['drawdirection'])
+            return patch, no_update, no_update, no_update, no_update
+        patch_axes(patch, x_type, x_min, x_max, y_type, y_min, y_max)
+        if switch_id in ('x-axis-min', 'x-axis-max') and x_min != None and x_max != None:
+            view['x'] = [x_min, x_max]
+        elif switch_id in ('y-axis-min', 'y-axis-max') and y_min != None and y_max != None:
+            view['y'] = [y_min, y_max]
+        elif view.get('transport') != 'image':
+            return patch, no_update, no_update, no_update, no_update
+        if (switch_id not in ('x-axis-type', 'y-axis-type')
+                and view_is_served(file_selection, view)):
+            return patch, no_update, no_update, view, no_update
+        note = patch_heatmap(patch, file_selection, view, x_type, y_type)
+        return patch, no_update, no_update, view, note
+    # A new file or transport: the only cases where the whole figure is sent
+    start = timer.perf_counter()
+    view = dict(file=file_selection, transport=transport)
+    timescale = DATA[file_selection].timescale   
+    time, wavelength, dtt, view['served'] = heatmap_view(file_selection, view)
+    with timed('imshow'):
+        import plotly.express as px
+        fig = px.imshow(dtt.transpose(),
+                        labels=dict(x='<b>Delay Time (' + timescale + ')</b>', 
+                                    y='<b>Wavelength (nm)</b>', 
+                                    color= '<b>' + DATA[file_selection].quantity + '</b>'),
+                        x = time,
+                        y = wavelength,
+                        aspect='auto', origin='lower', template = standard_template,
+                        color_continuous_scale=plotly.colors.diverging.RdBu)
+    # Keeps the user's zoom when a finer or coarser block is sent, or the
+    # preprocessing changes
+    fig.update_layout(uirevision=DATA[file_selection].filename)
     fig = update_axes(fig, x_type, x_min, x_max, y_type, y_min, y_max)
-    if time_switch_val:
-        fig.update_layout(clickmode='event+select', 
-                          dragmode='drawrect',
-                          modebar_add = ['drawrect', 'eraseshape'], 
-                          newshape = dict(drawdirection='vertical', 
-                                          fillcolor='red', line_width=0)
-                          )
-    else:
-        fig.update_layout(clickmode='event+select', 
-                          dragmode='drawrect',
-                          modebar_add = ['drawrect', 'eraseshape'], 
-                          newshape = dict(drawdirection='horizontal', 
-                                          fillcolor='red', line_width=0)
-                          ) 
-    return fig, time_clicks, wvl_clicks
+    fig.update_layout(**shape_layout(time_switch_val))
+    trace, layout = heatmap_payload(time, wavelength, dtt, transport, x_type, y_type)
+    if transport != 'json':
+        # Typed array specs don't pass plotly's validators, so they are
+        # swapped into the figure's plain dict form
+        fig = fig.to_plotly_json()
+        fig['data'][0].update(trace)
+        for key, value in layout.items():
+            if isinstance(value, dict):
+                fig['layout'].setdefault(key, {}).update(value)
+            else:
+                fig['layout'][key] = value
+    note = payload_note(payload_size(trace, layout), timer.perf_counter() - start,
+                        transport)
+    return fig, no_update, no_update, view, note
+
+# Marks when a new heatmap reaches the browser so assets/render_timing.js can
+# report how long plotly.js took to draw it
+app.clientside_callback(
+    """
+    function(figure) {
+        window.dash_clientside.renderStart = performance.now();
+        return window.dash_clientside.renderStart;
+    }
+    """,
+    Output('ta-render-start', 'data'),
+    Input('ta-graph', 'figure'),
+    prevent_initial_call=True)
+
+# Client-side slicing. The selected data goes to the browser once per
+# selection, from the finest pyramid level that fits in CLIENT_MAX_CELLS,
+# with what assets/client_slicing.js needs to draw traces like slice_trace.
+def client_matrix(file_selection):
+    data = DATA[file_selection]
+    for level in get_pyramid(file_selection):
+        if len(level['time']) * len(level['wavelength']) <= CLIENT_MAX_CELLS:
+            break
+    dtt = level['mean'] if 'mean' in level else level['dtt'][:, :]
+    return dict(file=file_selection, timescale=data.timescale,
+                time=pack_array(level['time']), wavelength=pack_array(level['wavelength']),
+                dtt=pack_array(dtt), shape=list(dtt.shape),
+                colors=plotly.colors.qualitative.Pastel)
+
+@app.callback(
+    Output('client-matrix', 'data'),
+    Input('data-selection', 'data'),
+    Input('client-slicing', 'value'),
+    prevent_initial_call=True)
+def update_client_matrix(file_selection, client_slicing):
+    if not client_slicing or file_selection == None:
+        return None
+    return client_matrix(file_selection)
+
+# A band drawn on the heatmap in client mode: adds it to its dropdown and
+# appends its trace to the kinetics or spectra graph in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace='slicing', function_name='add_slice'),
+    Output('kin-graph', 'figure', allow_duplicate=True),
+    Output('kin-shown', 'data', allow_duplicate=True),
+    Output('wvl-dropdown', 'options', allow_duplicate=True),
+    Output('wvl-dropdown', 'value', allow_duplicate=True),
+    Output('spec-graph', 'figure', allow_duplicate=True),
+    Output('spec-shown', 'data', allow_duplicate=True),
+    Output('time-dropdown', 'options', allow_duplicate=True),
+    Output('time-dropdown', 'value', allow_duplicate=True),
+    Output('client-slice', 'data'),
+    Input('ta-graph', 'relayoutData'),
+    State('client-slicing', 'value'),
+    State('client-matrix', 'data'),
+    State('time-switch', 'value'),
+    State('kin-graph', 'figure'),
+    State('kin-shown', 'data'),
+    State('wvl-dropdown', 'options'),
+    State('wvl-dropdown', 'value'),
+    State('spec-graph', 'figure'),
+    State('spec-shown', 'data'),
+    State('time-dropdown', 'options'),
+    State('time-dropdown', 'value'),
+    prevent_initial_call=True)
+
+# Saves a slice drawn in the browser to the session, where fits, typed-in
+# slices and later redraws look for it
+@app.callback(
+    Input('client-slice', 'data'),
+    State('session-id', 'data'),
+    prevent_initial_call=True)
+def save_client_slice(client_slice, session_id):
+    if client_slice:
+        add_slice(session_id, client_slice['kind'], client_slice['key'],
+                  client_slice['bounds'])
+
+# Fitted curve for each wavelength slice in `keys`. A fit to all wavelengths
+# is averaged over the slice's band; a fit to slices is used where the same
+# slice was fitted.
+def fit_overlay(data, fit_result, slices, keys):
+    fit = get_fit(fit_result)
+    curves = {}
+    for key in keys:
+        if fit_result['keys'] is None:
+            start, stop = slice_indices(data.wavelength, [slices[key]])
+            curves[key] = np.nanmean(fit_curves(data.time, fit, slice(start[0], stop[0])),
+                                     axis=1)
+        elif key in fit_result['keys']:
+            row = fit_result['keys'].index(key)
+            curves[key] = fit_curves(data.time, fit, slice(row, row + 1))[:, 0]
+    return curves
+
+# Resamples the columns of `columns` (sampled at x) onto `grid` by linear
+# interpolation, NaN outside x. The interpolation indices and weights are
+# found once and applied to every column.
+def resample_columns(x, columns, grid):
+    if np.array_equal(x, grid):
+        return columns
+    order = np.argsort(x)
+    x = x[order]
+    columns = columns[order]
+    pos = np.clip(np.searchsorted(x, grid), 1, len(x) - 1)
+    weight = ((grid - x[pos - 1]) / (x[pos] - x[pos - 1]))[:, None]
+    result = columns[pos - 1] + weight * (columns[pos] - columns[pos - 1])
+    result[(grid < x[0]) | (grid > x[-1])] = np.nan
+    return result
+
+# Selection of another file seen through the same preprocessing as
+# `selection`. Excluded scans are specific to a file, so they are dropped,
+# as is scan averaging for a file without scans.
+def overlay_selection(selection, filename):
+    base, sep, pipeline_id = selection.rpartition('#')
+    if not sep:
+        return filename
+    with open(pipeline_path(pipeline_id)) as f:
+        pipeline = json.load(f)
+    if pipeline[0][0] == 'average':
+        if DATA[filename].scans:
+            pipeline[0][1]['exclude'] = []
+        else:
+            pipeline = pipeline[1:]
+    return pipeline_selection(filename, pipeline)
+
+# Band averages of `other` over `bounds` along `axis`, resampled onto the
+# other axis of `data`. Each slice is cached on `other`'s record per grid, so
+# overlaying one more file or slice computes only that file or slice.
+@timed('overlay')
+def overlay_traces(other, axis, bounds, data):
+    grid = data.time if axis == 1 else data.wavelength
+    keys = [('overlay', axis, data.key, tuple(b)) for b in bounds]
+    missing = [b for b, key in zip(bounds, keys) if key not in other.cache]
+    if missing:
+        x = other.time if axis == 1 else other.wavelength
+        columns = resample_columns(x, band_average(other, axis, missing), grid)
+        for index, b in enumerate(missing):
+            other.store(('overlay', axis, data.key, tuple(b)), columns[:, index])
+    if not keys:
+        return np.empty((len(grid), 0))
+    return np.column_stack([other.cache[key] for key in keys])
+
+# Adds the slices `keys` of every overlaid file to a kinetics (axis=1) or
+# spectra (axis=0) figure of `data`, in the colour of the slice and a line
+# style per file
+def add_overlays(fig, data, axis, slices, keys, overlay_files, options):
+    colors = plotly.colors.qualitative.Pastel
+    grid = data.time if axis == 1 else data.wavelength
+    for number, filename in enumerate(overlay_files):
+        other = DATA[overlay_selection(data.name, filename)]
+        traces = overlay_traces(other, axis, [slices[key] for key in keys], data)
+        label = os.path.basename((options or {}).get(filename, filename))
+        for index, key in enumerate(keys):
+            fig.add_trace(dict(type='scatter', mode='lines', x=grid, y=traces[:, index],
+                               name=key + ' (' + label + ')', line=dict(
+                                   color=colors[index % len(colors)],
+                                   dash=OVERLAY_DASHES[number % len(OVERLAY_DASHES)])))
+    return fig
+
+# Files that can be overlaid are the loaded files; deleted ones are dropped
+@app.callback(
+    Output('overlay-files', 'options'),
+    Output('overlay-files', 'value'),
+    Input('file-dropdown', 'options'),
+    State('overlay-files', 'value'),
+    prevent_initial_call=True)
+def update_overlay_options(options, value):
+    return options, [filename for filename in (value or []) if filename in (options or {})]
 
 @app.callback(
     Output('kin-graph', 'figure'),
-    Input('file-dropdown', 'value'),
+    Output('kin-shown', 'data'),
+    Input('data-selection', 'data'),
     Input('wvl-dropdown', 'value'),
     Input('wvl-from-clear', 'n_clicks'),
     Input('x-axis-type', 'value'),
@@ -532,40 +3244,58 @@ def update_ta_graph(file_selection, time_switch_val, relayoutData,
     Input('y-axis-type', 'value'),
     Input('y-axis-min', 'value'),
     Input('y-axis-max', 'value'),
+    Input('fit-result', 'data'),
+    Input('overlay-files', 'value'),
+    State('kin-shown', 'data'),
+    State('session-id', 'data'),
+    State('file-dropdown', 'options'),
+    State('client-slice', 'data'),
     prevent_initial_call=True)
 def update_kin_graph(file_selection, value, n_clicks, x_type, x_min, x_max,
-                     y_type, y_min, y_max):
+                     y_type, y_min, y_max, fit_result, overlay_files, shown,
+                     session_id, options, client_slice):
     ctx = dash.callback_context
     switch_id = ctx.triggered[0]['prop_id'].split('.')[0]
     if switch_id == 'wvl-from-clear':
-        return blank_fig
-    elif WVL_SLICES.empty or file_selection == None:
+        return blank_fig, {}
+    slices = known_slices(session_id, 'wvl', client_slice)
+    if not slices or file_selection == None:
         raise PreventUpdate
+    data = DATA[file_selection]
+    compute = lambda keys: kinetics(data, [slices[key] for key in keys])
+    errors = lambda keys: band_error(data, 1, [slices[key] for key in keys])
+    fitted = (fit_result or {}).get('file') == file_selection
+    overlays = [filename for filename in (overlay_files or []) if filename != data.filename]
+    if (shown or {}).get('file') != file_selection or switch_id in ('fit-result', 'overlay-files') or (
+            (fitted or overlays) and switch_id == 'wvl-dropdown'):
+        # Fits and other files are drawn after the slices, so a figure
+        # showing them is redrawn in full rather than patched
+        fig = slice_figure(data.time, compute(value), value,
+                           '<b>Delay Time (' + data.timescale + ')</b>', errors(value),
+                           data.quantity)
+        if fitted:
+            colors = plotly.colors.qualitative.Pastel
+            for key, curve in fit_overlay(data, fit_result, slices, value).items():
+                fig.add_trace(dict(type='scatter', mode='lines', x=data.time, y=curve,
+                                   name='Fit: ' + key, line=dict(
+                                       dash='dash', color=colors[value.index(key) % len(colors)])))
+        fig = add_overlays(fig, data, 1, slices, value, overlays, options)
+        fig = update_axes(fig, x_type, x_min, x_max, y_type, y_min, y_max)
+        return fig, dict(file=file_selection, keys=list(value))
+    elif switch_id == 'wvl-dropdown':
+        if list(value) == shown['keys']:
+            # Already drawn in the browser
+            raise PreventUpdate
+        return patch_slice_figure(shown, value, data.time, compute, errors)
     else:
-        dtt = DATA.loc['dtt', file_selection]
-        wavelength = DATA.loc['wavelength', file_selection]
-        timescale = DATA.loc['timescale', file_selection]
-        kin = pd.DataFrame(dict(time = DATA.loc['time', file_selection]))
-        for key in value:
-            [wvl_min, wvl_max] = WVL_SLICES[key]
-            [index_min, __] = take_closest(wavelength, wvl_min)
-            [index_max, __] = take_closest(wavelength, wvl_max)
-            kin[key] = np.mean(dtt[:, index_min:index_max], axis=1)
-        fig = px.line(kin, x='time', y = kin.columns[1:],
-                      template=standard_template,
-                      color_discrete_sequence = px.colors.qualitative.Pastel)
-        fig.update_layout(legend_x=1,
-                          legend_xanchor='right',
-                          legend_title_text = '',
-                          xaxis=dict(title_text = '<b>Delay Time (' + timescale + ')</b>'),
-                          yaxis=dict(title_text='<b>\u0394'+ 'T/T</b>'))
-        fig = update_axes(fig,x_type, x_min, x_max, y_type, y_min, y_max)
-        return fig
+        patch = patch_axes(dash.Patch(), x_type, x_min, x_max, y_type, y_min, y_max)
+        return patch, no_update
 
 
 @app.callback(
     Output('spec-graph', 'figure'),
-    Input('file-dropdown', 'value'),
+    Output('spec-shown', 'data'),
+    Input('data-selection', 'data'),
     Input('time-dropdown', 'value'),
     Input('time-from-clear', 'n_clicks'),
     Input('x-axis-type', 'value'),
@@ -574,36 +3304,730 @@ def update_kin_graph(file_selection, value, n_clicks, x_type, x_min, x_max,
     Input('y-axis-type', 'value'),
     Input('y-axis-min', 'value'),
     Input('y-axis-max', 'value'),
+    Input('overlay-files', 'value'),
+    State('spec-shown', 'data'),
+    State('session-id', 'data'),
+    State('file-dropdown', 'options'),
+    State('client-slice', 'data'),
     prevent_initial_call=True)
 def update_spec_graph(file_selection, value, n_clicks, x_type, x_min, x_max,
-                      y_type, y_min, y_max):
+                      y_type, y_min, y_max, overlay_files, shown, session_id, options,
+                      client_slice):
     ctx = dash.callback_context
     switch_id = ctx.triggered[0]['prop_id'].split('.')[0]
     if switch_id == 'time-from-clear':
-        return blank_fig
-    elif TIME_SLICES.empty or file_selection == None:
+        return blank_fig, {}
+    slices = known_slices(session_id, 'time', client_slice)
+    if not slices or file_selection == None:
         raise PreventUpdate
-    else:
-        dtt = DATA.loc['dtt', file_selection]
-        time = DATA.loc['time', file_selection]
-        spec = pd.DataFrame(dict(wavelength = DATA.loc['wavelength', file_selection]))
-        for key in value:
-            [time_min, time_max] = TIME_SLICES[key]
-            [index_min, __] = take_closest(time, time_min)
-            [index_max, __] = take_closest(time, time_max)
-            spec[key] = np.mean(dtt[index_min:index_max, :], axis=0)
-        fig = px.line(spec, x='wavelength', y=spec.columns[1:], 
-                      template = standard_template, 
-                      color_discrete_sequence = px.colors.qualitative.Pastel)
-        fig.update_layout(legend_title_text = '',
-                          legend_x = 1, 
-                          legend_xanchor = 'right',
-                          xaxis=dict(title_text = '<b>Wavelength (nm)</b>'),
-                          yaxis=dict(title_text='<b>\u0394'+ 'T/T</b>'))
+    data = DATA[file_selection]
+    compute = lambda keys: spectra(data, [slices[key] for key in keys])
+    errors = lambda keys: band_error(data, 0, [slices[key] for key in keys])
+    overlays = [filename for filename in (overlay_files or []) if filename != data.filename]
+    if (shown or {}).get('file') != file_selection or switch_id == 'overlay-files' or (
+            overlays and switch_id == 'time-dropdown'):
+        fig = slice_figure(data.wavelength, compute(value), value,
+                           '<b>Wavelength (nm)</b>', errors(value), data.quantity)
+        fig = add_overlays(fig, data, 0, slices, value, overlays, options)
         fig = update_axes(fig, x_type, x_min, x_max, y_type, y_min, y_max)
-        return fig
+        return fig, dict(file=file_selection, keys=list(value))
+    elif switch_id == 'time-dropdown':
+        if list(value) == shown['keys']:
+            # Already drawn in the browser
+            raise PreventUpdate
+        return patch_slice_figure(shown, value, data.wavelength, compute, errors)
+    else:
+        patch = patch_axes(dash.Patch(), x_type, x_min, x_max, y_type, y_min, y_max)
+        return patch, no_update
+
+# Exports. Each selection gives one table: a name, its column names and a
+# function yielding blocks of rows, so a writer only ever holds one block. The
+# name comes from `label`, the file's name in the dropdown, as an uploaded
+# file is stored under its hash.
+def export_table(selection, what, session_id, label=None):
+    data = DATA[selection]
+    name = secure_filename(os.path.splitext(os.path.basename(label or ''))[0]) or \
+        os.path.splitext(os.path.basename(data.filename))[0]
+    if what == 'map':
+        columns = ['delay (' + data.timescale + ')'] + ['%g nm' % w for w in data.wavelength]
+        def blocks():
+            cached = data.loaded or shared_exists(data, 'dtt.npy')
+            dtt = data.dtt if cached else data.source
+            step = max(1, EXPORT_BLOCK_BYTES // (8 * len(columns)))
+            for start in range(0, len(data.time), step):
+                yield np.column_stack([data.time[start:start + step],
+                                       dtt[start:start + step, :]])
+        return name, columns, blocks
+    kind = 'wvl' if what == 'kinetics' else 'time'
+    slices = get_slices(session_id, kind)
+    if not slices:
+        raise ValueError('No ' + ('wavelength' if kind == 'wvl' else 'time') + ' slices to export')
+    if what == 'kinetics':
+        x, x_name = data.time, 'delay (' + data.timescale + ')'
+        traces = lambda: kinetics(data, list(slices.values()))
+    else:
+        x, x_name = data.wavelength, 'wavelength (nm)'
+        traces = lambda: spectra(data, list(slices.values()))
+    return name + '_' + what, [x_name] + list(slices), lambda: iter(
+        [np.column_stack([x, traces()])])
+
+# CSV text of a table, a block at a time
+def csv_chunks(columns, blocks):
+    yield (','.join(columns) + '\n').encode()
+    for block in blocks():
+        text = io.StringIO()
+        np.savetxt(text, block, delimiter=',', fmt='%.8g')
+        yield text.getvalue().encode()
+
+# Writes tables to an HDF5 file, one gzip-compressed dataset per table with
+# its column names in a 'columns' attribute, growing it a block at a time
+def write_export_hdf5(path, tables):
+    with h5py.File(path, 'w') as f:
+        for name, columns, blocks in tables:
+            dataset = f.create_dataset(name, shape=(0, len(columns)), dtype='f8',
+                                       maxshape=(None, len(columns)), chunks=True,
+                                       compression='gzip')
+            dataset.attrs['columns'] = columns
+            for block in blocks():
+                rows = dataset.shape[0]
+                dataset.resize(rows + len(block), axis=0)
+                dataset[rows:] = block
+
+# Writes a table to a Parquet file, one row group per block
+def write_export_parquet(path, columns, blocks):
+    schema = pa.schema([(column, pa.float64()) for column in columns])
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for block in blocks():
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(block[:, i]) for i in range(block.shape[1])], schema=schema))
+
+# Streams a file written by `write(path)` and deletes it afterwards
+def spooled_chunks(write):
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=SPOOL_DIR, suffix='.export')
+    os.close(fd)
+    try:
+        write(path)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b''):
+                yield chunk
+    finally:
+        os.remove(path)
+
+# Write-only sink for zipfile: collects what was written until taken
+class ZipSink:
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+# ZIP archive of (filename, chunks) entries, streamed as it is written.
+# zipfile doesn't seek on a sink without tell(); entry sizes follow the data.
+def zip_chunks(entries):
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for filename, chunks in entries:
+            with archive.open(filename, 'w', force_zip64=True) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    yield sink.take()
+    yield sink.take()
+
+# Streamed download of maps, kinetics or spectra:
+#   export?what=map|kinetics|spectra&format=csv|hdf5|parquet&data=<selection>&session=<id>
+# with `data` repeated for several files. Several tables are zipped, except
+# in HDF5, where they are datasets of one file. Only uploaded or loaded
+# files can be exported.
+@app.server.route('/export')
+def export_data():
+    args = flask.request.args
+    what, fmt = args.get('what', 'map'), args.get('format', 'csv')
+    selections = args.getlist('data')
+    if what not in ('map', 'kinetics', 'spectra') or fmt not in EXPORT_FORMATS or not selections:
+        return flask.jsonify(error='Nothing to export'), 400
+    if fmt == 'parquet' and pa is None:
+        return flask.jsonify(error='Parquet export needs pyarrow'), 400
+    labels = args.getlist('label')
+    tables, names = [], set()
+    for index, selection in enumerate(selections):
+        filename = selection_filename(selection)
+        if filename not in DATA and not allowed_file(filename):
+            return flask.jsonify(error='Unknown file ' + filename), 400
+        try:
+            name, columns, blocks = export_table(selection, what, args.get('session'),
+                                                 labels[index] if index < len(labels) else None)
+        except (OSError, ValueError) as e:
+            return flask.jsonify(error=str(e)), 400
+        while name in names:
+            name += '_'
+        names.add(name)
+        tables.append((name, columns, blocks))
+
+    label, mimetype, ext = EXPORT_FORMATS[fmt]
+    if fmt == 'hdf5':
+        chunks = spooled_chunks(lambda path: write_export_hdf5(path, tables))
+    else:
+        if fmt == 'csv':
+            entries = [(name + ext, csv_chunks(columns, blocks))
+                       for name, columns, blocks in tables]
+        else:
+            entries = [(name + ext, spooled_chunks(
+                lambda path, columns=columns, blocks=blocks:
+                write_export_parquet(path, columns, blocks)))
+                for name, columns, blocks in tables]
+        if len(entries) == 1:
+            chunks = entries[0][1]
+        else:
+            chunks = zip_chunks(entries)
+            mimetype, ext = 'application/zip', '.zip'
+    filename = (tables[0][0] if len(tables) == 1 else 'export_' + what) + ext
+    return flask.Response(flask.stream_with_context(chunks), mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename="' + filename + '"'})
+
+# Points the download link at /export for the current selection, with the
+# compared files if asked for
+@app.callback(
+    Output('export-link', 'href'),
+    Input('data-selection', 'data'),
+    Input('overlay-files', 'value'),
+    Input('export-what', 'value'),
+    Input('export-format', 'value'),
+    Input('export-overlays', 'value'),
+    Input('session-id', 'data'),
+    State('file-dropdown', 'options'))
+def update_export_link(file_selection, overlay_files, what, fmt, with_overlays, session_id,
+                       options):
+    if file_selection == None:
+        return None
+    selections = [file_selection]
+    if with_overlays:
+        filename = DATA[file_selection].filename
+        selections += [overlay_selection(file_selection, other)
+                       for other in overlay_files or [] if other != filename]
+    labels = [(options or {}).get(selection_filename(selection), selection_filename(selection))
+              for selection in selections]
+    return 'export?' + urlencode(dict(what=what, format=fmt, session=session_id,
+                                      data=selections, label=labels), doseq=True)
+
+# Batch mode: computes the same kinetics and spectra as the kin/spec graphs
+# for every file in a directory, without the UI. Run as
+#   python strankslab-data-analysis.py batch <directory> -t 100:200 -w 500:520 -o out.hdf5
+# Each file is processed in its own worker process and the results are written
+# to one HDF5 file with a group per input file.
+
+# Parses a slice given on the command line as 'min:max' or a single value
+def parse_slice(text):
+    lo, _, hi = text.partition(':')
+    lo = float(lo) if lo.strip() else None
+    hi = float(hi) if hi.strip() else None
+    if lo == None and hi == None:
+        raise argparse.ArgumentTypeError('empty slice: ' + repr(text))
+    return [lo, hi]
+
+# dtt of a file read straight from HDF5 for batch mode, given its read_axes
+# header. Files with scans but no 'Average' get the mean of their scans,
+# summed one scan at a time.
+def batch_dtt(filename, header):
+    kind, average = str(header['kind']), str(header['average'])
+    if kind == 'tcspc':
+        return header['dtt']
+    elif kind == 'pl-spectrum':
+        return read_spectra(filename)
+    elif average:
+        source = LazyDTT(filename, average)
+        try:
+            return source[:, :]
+        finally:
+            source.close()
+    rows = slice(0, len(header['time']))
+    total, count = 0, 0
+    with h5py.File(filename, 'r') as f:
+        for scan in scan_datasets(f):
+            block = scan_block(f, scan, rows).astype(np.float64)
+            finite = np.isfinite(block)
+            total = total + np.where(finite, block, 0)
+            count = count + finite
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
+
+# Band averages of an in-memory dtt, as band_average gives for a record
+def batch_bands(dtt, axis_values, bounds, axis):
+    if len(bounds) == 0:
+        return np.empty((dtt.shape[1 - axis], 0))
+    finite = np.isfinite(dtt)
+    counts = None if finite.all() else cumulative(finite, axis, np.int32)
+    sums = cumulative(np.where(finite, dtt, 0), axis, np.float64)
+    return band_means((sums, counts), slice_indices(axis_values, bounds), axis)
+
+# Kinetics and spectra of one file for batch mode. The file is read directly
+# (axes by read_axes, dtt by batch_dtt) rather than through open_dataset, so
+# it isn't hashed or copied into the shared cache, and the read time is always
+# that of the file, not of a cache left by an earlier run. Errors are returned
+# rather than raised so one bad file doesn't stop the batch.
+def batch_file(filename, time_bounds, wvl_bounds):
+    result = dict(filename=filename, size=os.path.getsize(filename))
+    try:
+        start = timer.perf_counter()
+        header = read_axes(filename, None)
+        dtt = batch_dtt(filename, header)
+        read = timer.perf_counter()
+        result.update(time=header['time'], wavelength=header['wavelength'],
+                      timescale=str(header['timescale']),
+                      kinetics=batch_bands(dtt, header['wavelength'], wvl_bounds, 1),
+                      spectra=batch_bands(dtt, header['time'], time_bounds, 0))
+        result.update(read_seconds=read - start,
+                      slice_seconds=timer.perf_counter() - read)
+    except Exception as e:
+        result['error'] = type(e).__name__ + ': ' + str(e)
+    return result
+
+# Writes batch results to HDF5: /<file>/{time, wavelength, kinetics, spectra}
+# with the slice labels and bounds as attributes, and a /summary group of
+# per-file columns (file, size, read and slice times, error)
+def write_batch(output, results, time_bounds, wvl_bounds):
+    with h5py.File(output, 'w') as f:
+        for result in results:
+            if 'error' in result:
+                continue
+            group = f.create_group(os.path.basename(result['filename']))
+            group.attrs['source'] = os.path.abspath(result['filename'])
+            group.attrs['timescale'] = result['timescale']
+            group['time'] = result['time']
+            group['wavelength'] = result['wavelength']
+            for name, bounds, unit in (('kinetics', wvl_bounds, 'nm'),
+                                       ('spectra', time_bounds, result['timescale'])):
+                group.create_dataset(name, data=result[name], compression='gzip')
+                group[name].attrs['slices'] = [slice_key(lo, hi, unit) for lo, hi in bounds]
+                group[name].attrs['bounds'] = np.array(bounds, dtype=np.float64)
+        summary = f.create_group('summary')
+        summary['file'] = [os.path.basename(r['filename']) for r in results]
+        summary['bytes'] = [r['size'] for r in results]
+        summary['read_seconds'] = [r.get('read_seconds', np.nan) for r in results]
+        summary['slice_seconds'] = [r.get('slice_seconds', np.nan) for r in results]
+        summary['error'] = [r.get('error', '') for r in results]
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='strankslab-data-analysis.py batch',
+        description='Compute kinetics and spectra for every TA file in a directory.')
+    parser.add_argument('directory')
+    parser.add_argument('-t', '--time', action='append', type=parse_slice, default=[],
+                        metavar='MIN:MAX', help='delay window for a spectrum (repeatable)')
+    parser.add_argument('-w', '--wvl', action='append', type=parse_slice, default=[],
+                        metavar='MIN:MAX', help='wavelength band for a kinetic (repeatable)')
+    parser.add_argument('-o', '--output', default='batch.hdf5')
+    parser.add_argument('-p', '--pattern', default='*.hdf5',
+                        help="file name pattern (default '*.hdf5')")
+    parser.add_argument('-j', '--workers', type=int, default=JOB_WORKERS)
+    args = parser.parse_args(argv)
+    if not args.time and not args.wvl:
+        parser.error('give at least one --time or --wvl slice')
+    files = sorted(glob.glob(os.path.join(args.directory, args.pattern)))
+    if not files:
+        parser.error('no files matching ' + args.pattern + ' in ' + args.directory)
+
+    start = timer.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(batch_file, filename, args.time, args.wvl)
+                   for filename in files]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            name = os.path.basename(result['filename'])
+            if 'error' in result:
+                print(name + ': ' + result['error'])
+                continue
+            seconds = result['read_seconds'] + result['slice_seconds']
+            print('%s: %.1f MB, read %.2f s, sliced %.3f s (%.1f MB/s)' % (
+                name, result['size'] / 2**20, result['read_seconds'],
+                result['slice_seconds'], result['size'] / 2**20 / max(seconds, 1e-9)))
+    results.sort(key=lambda result: result['filename'])
+    write_batch(args.output, results, args.time, args.wvl)
+
+    elapsed = timer.perf_counter() - start
+    done = [r for r in results if 'error' not in r]
+    total = sum(r['size'] for r in done) / 2**20
+    print('%d of %d files, %.1f MB in %.2f s (%.2f files/s, %.1f MB/s) -> %s' % (
+        len(done), len(results), total, elapsed, len(done) / elapsed,
+        total / elapsed, args.output))
+    return 0 if len(done) == len(results) else 1
+
+# Global analysis graphs. The decomposition only runs when asked for (Run SVD);
+# changing file or number of components shows a saved decomposition if there
+# is one.
+@app.callback(
+    Output('svd-spec-graph', 'figure'),
+    Output('svd-values-graph', 'figure'),
+    Output('svd-kin-graph', 'figure'),
+    Output('svd-status', 'children'),
+    Input('svd-run', 'n_clicks'),
+    Input('data-selection', 'data'),
+    Input('svd-components', 'value'),
+    prevent_initial_call=True)
+def update_svd_graphs(n_clicks, file_selection, components):
+    ctx = dash.callback_context
+    switch_id = ctx.triggered[0]['prop_id'].split('.')[0]
+    if file_selection == None:
+        return blank_fig, blank_fig, blank_fig, ''
+    components = max(int(components or SVD_SHOWN), 1)
+    rank = max(SVD_RANK, components)
+    data = DATA[file_selection]
+    saved = shared_exists(data, svd_name(rank))
+    if switch_id != 'svd-run' and not saved:
+        return blank_fig, blank_fig, blank_fig, ''
+    start = timer.perf_counter()
+    svd = get_svd(file_selection, rank)
+    keys = ['Component ' + str(i + 1) for i in range(components)]
+    spec_fig = slice_figure(data.wavelength, svd['spectra'][:, :components], keys,
+                            '<b>Wavelength (nm)</b>')
+    kin_fig = slice_figure(data.time, svd['kinetics'][:, :components] * svd['values'][:components],
+                           keys, '<b>Delay Time (' + data.timescale + ')</b>')
+    spec_fig.update_layout(yaxis_title_text='<b>Spectral component</b>')
+    kin_fig.update_layout(yaxis_title_text='<b>Amplitude</b>')
+    if saved:
+        status = 'Saved decomposition'
+    else:
+        status = ('Rank ' + str(rank) + ' SVD of ' + ' x '.join(str(n) for n in data.dtt.shape)
+                  + ' in ' + str(round(timer.perf_counter() - start, 2)) + ' s')
+    return spec_fig, svd_values_figure(svd['values'], components), kin_fig, status
+
+# Runs a kinetic fit on the selected file. Lifetimes are starting values in
+# the file's delay unit; the IRF FWHM defaults to a tenth of the shortest one.
+@app.callback(
+    Output('fit-result', 'data'),
+    Output('fit-status', 'children'),
+    Input('fit-run', 'n_clicks'),
+    State('data-selection', 'data'),
+    State('fit-lifetimes', 'value'),
+    State('fit-irf', 'value'),
+    State('fit-t0', 'value'),
+    State('fit-mode', 'value'),
+    State('fit-target', 'value'),
+    State('wvl-dropdown', 'value'),
+    State('session-id', 'data'),
+    prevent_initial_call=True)
+def fit_kinetics(n_clicks, file_selection, lifetimes, fwhm, t0, mode, target,
+                 wvl_keys, session_id):
+    if file_selection == None:
+        return no_update, 'Select a file to fit'
+    try:
+        lifetimes = [float(v) for v in re.split(r'[,;\s]+', lifetimes or '') if v]
+    except ValueError:
+        return no_update, 'Lifetimes must be numbers'
+    if not lifetimes or min(lifetimes) <= 0:
+        return no_update, 'Enter one or more positive lifetimes'
+    keys = None
+    bands = None
+    if target == 'slices':
+        slices = get_slices(session_id, 'wvl')
+        keys = [key for key in wvl_keys or [] if key in slices]
+        if not keys:
+            return no_update, 'Select wavelength slices to fit'
+        bands = [slices[key] for key in keys]
+    data = DATA[file_selection]
+    fwhm = fwhm if fwhm and fwhm > 0 else min(lifetimes) / 10
+    settings = dict(lifetimes=lifetimes, fwhm=fwhm, t0=t0 or 0, shared=mode == 'global',
+                    bands=bands)
+    start = timer.perf_counter()
+    try:
+        name = run_fit(file_selection, **settings)
+    except (ValueError, np.linalg.LinAlgError) as e:
+        return no_update, 'Fit failed: ' + str(e)
+    fit_result = dict(file=file_selection, name=name, keys=keys, settings=settings)
+    fit = get_fit(fit_result)
+    elapsed = str(round(timer.perf_counter() - start, 2)) + ' s'
+    if mode == 'global':
+        lifetimes = fit['lifetimes'][np.isfinite(fit['rms'])][0]
+        status = ('Lifetimes ' + ', '.join('%.3g' % tau for tau in lifetimes)
+                  + ' ' + data.timescale + ', rms %.3g' % np.sqrt(np.nanmean(fit['rms']**2))
+                  + ' (' + elapsed + ')')
+    else:
+        status = (str(len(fit['rms'])) + ' kinetics fitted, median rms %.3g' %
+                  np.nanmedian(fit['rms']) + ' (' + elapsed + ')')
+    return fit_result, status
+
+# Lifetime/amplitude map of the current fit as CSV: one row per wavelength
+# (or fitted slice) with every lifetime, amplitude, t0, IRF FWHM and rms
+@app.callback(
+    Output('fit-download', 'data'),
+    Input('fit-export', 'n_clicks'),
+    State('fit-result', 'data'),
+    State('file-dropdown', 'options'),
+    prevent_initial_call=True)
+def export_fit(n_clicks, fit_result, options):
+    if not (fit_result or {}).get('name'):
+        raise PreventUpdate
+    data = DATA[fit_result['file']]
+    fit = get_fit(fit_result)
+    import pandas as pd
+    if fit_result['keys'] is None:
+        table = pd.DataFrame({'wavelength (nm)': data.wavelength})
+    else:
+        table = pd.DataFrame({'slice': fit_result['keys']})
+    for i in range(fit['lifetimes'].shape[1]):
+        table['tau' + str(i + 1) + ' (' + data.timescale + ')'] = fit['lifetimes'][:, i]
+        table['A' + str(i + 1)] = fit['amplitudes'][:, i]
+    table['t0 (' + data.timescale + ')'] = fit['t0']
+    table['IRF FWHM (' + data.timescale + ')'] = fit['sigma'] * 2.3548
+    table['rms'] = fit['rms']
+    filename = os.path.splitext(os.path.basename((options or {}).get(data.filename, data.filename)))[0]
+    return dcc.send_data_frame(table.to_csv, filename + '_fit.csv', index=False)
+
+# All callbacks are defined; time them for /metrics
+instrument_callbacks(app)
+
+# Benchmarks: times the app's callbacks on synthetic TA files by calling them
+# directly, without a browser. Run as
+#   python strankslab-data-analysis.py bench -s 300x200 -s 2000x1000 -n 1 -n 10 -n 100 -o bench.json
+# Results are written as JSON, so runs before and after a change can be compared.
+BENCH_SIZES = ['300x200', '1000x700', '3000x1500']
+BENCH_SLICES = [1, 10, 100]
+
+# Writes a synthetic TA file in the 'Average' layout (row 0 wavelengths,
+# column 0 delays): two decaying bands with an instrument rise, plus noise
+def synthetic_ta(filename, delays, wavelengths, seed=0):
+    rng = np.random.default_rng(seed)
+    time = np.concatenate([np.linspace(-1, 10, delays // 2, endpoint=False),
+                           np.geomspace(10, 5000, delays - delays // 2)])
+    wavelength = np.linspace(400, 800, wavelengths)
+    from scipy.special import erfc
+    rise = 0.5 * erfc(-time / 0.3)
+    dtt = (np.outer(rise * np.exp(-time.clip(0) / 50), np.exp(-((wavelength - 550) / 40)**2))
+           - np.outer(rise * np.exp(-time.clip(0) / 800), 0.6 * np.exp(-((wavelength - 680) / 60)**2)))
+    dtt += 0.01 * rng.standard_normal(dtt.shape)
+    block = np.zeros((delays + 1, wavelengths + 1))
+    block[0, 1:] = wavelength
+    block[1:, 0] = time
+    block[1:, 1:] = dtt
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('Average', data=block).attrs['delay type'] = 'Long'
+
+# Calls a callback's function outside a request, with `trigger` as the
+# property that dash.callback_context reports as having fired. Depending on
+# the dash version the decorated name is the function or a request wrapper.
+# Setting the context needs private dash modules, imported here so that only
+# the bench depends on them.
+def call_callback(callback, trigger, *args):
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict
+    token = context_value.set(AttributeDict(
+        triggered_inputs=[{'prop_id': trigger, 'value': None}]))
+    try:
+        return getattr(callback, '__wrapped__', callback)(*args)
+    finally:
+        context_value.reset(token)
+
+# Median wall time of `repeats` calls of `function`, and its last result
+def time_calls(function, repeats):
+    seconds = []
+    for i in range(repeats):
+        start = timer.perf_counter()
+        result = function()
+        seconds.append(timer.perf_counter() - start)
+    return float(np.median(seconds)), result
+
+# Size of the callback outputs as dash serializes them for the response
+def response_size(outputs):
+    return len(json.dumps(outputs, cls=PlotlyJSONEncoder))
+
+# Evenly spaced [min, max] slices over an axis, keyed as the UI keys them
+def bench_slices(axis, count, unit):
+    edges = np.linspace(axis.min(), axis.max(), 2 * count + 1)
+    return {slice_key(round(lo, 2), round(hi, 2), unit): [lo, hi]
+            for lo, hi in zip(edges[1::2], edges[2::2])}
+
+# Times one slice graph drawn from scratch with `count` slices, then adding
+# one more slice to it (a patch)
+def bench_slice_graph(callback, filename, kind, count, unit, axis, session_id, repeats):
+    clear_slices(session_id, kind)
+    slices = bench_slices(axis, count + 1, unit)
+    for key, bounds in slices.items():
+        add_slice(session_id, kind, key, bounds)
+    keys = list(slices)
+    trigger = ('wvl' if kind == 'wvl' else 'time') + '-dropdown.value'
+    extra = [None, []] if kind == 'wvl' else [[]]
+    axes = ['linear', None, None, 'linear', None, None]
+    seconds, (fig, shown) = time_calls(lambda: call_callback(
+        callback, 'data-selection.data', filename, keys[:count], 0, *axes,
+        *extra, {}, session_id, {}, None), repeats)
+    patch_seconds, outputs = time_calls(lambda: call_callback(
+        callback, trigger, filename, keys, 0, *axes, *extra, shown, session_id, {}, None),
+        repeats)
+    return dict(slices=count, seconds=seconds, bytes=response_size([fig, shown]),
+                add_one_seconds=patch_seconds, add_one_bytes=response_size(outputs))
+
+# Benchmarks one file: opening it cold (nothing cached) and warm, the TA
+# heatmap for each transport, and the kinetics and spectra graphs
+def bench_file(filename, slice_counts, repeats):
+    session_id = 'bench-' + uuid.uuid4().hex
+    result = dict(file=os.path.basename(filename), bytes=os.path.getsize(filename))
+    shutil.rmtree(cache_dir(shared_key(filename)), ignore_errors=True)
+    if os.path.exists(index_path(filename)):
+        os.remove(index_path(filename))
+    start = timer.perf_counter()
+    import_data({}, filename)
+    DATA[filename].dtt
+    result['import_cold_seconds'] = timer.perf_counter() - start
+    def reopen():
+        DATA.remove(filename)
+        import_data({}, filename)
+        DATA[filename].dtt
+    result['import_warm_seconds'], _ = time_calls(reopen, repeats)
+    data = DATA[filename]
+    result.update(delays=len(data.time), wavelengths=len(data.wavelength))
+
+    result['ta'] = {}
+    for transport in ('json', 'binary', 'image'):
+        seconds, outputs = time_calls(lambda: call_callback(
+            update_ta_graph, 'data-selection.data', filename, False, None,
+            'linear', None, None, 'linear', None, None, transport, 0, 0, {},
+            session_id, False), repeats)
+        result['ta'][transport] = dict(seconds=seconds, bytes=response_size(outputs))
+
+    result['kinetics'] = [bench_slice_graph(update_kin_graph, filename, 'wvl', count,
+                                            'nm', data.wavelength, session_id, repeats)
+                          for count in slice_counts]
+    result['spectra'] = [bench_slice_graph(update_spec_graph, filename, 'time', count,
+                                           data.timescale, data.time, session_id, repeats)
+                         for count in slice_counts]
+    os.remove(session_path(session_id))
+    DATA.remove(filename)
+    return result
+
+def bench_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='strankslab-data-analysis.py bench',
+        description='Time the dashboard callbacks on synthetic TA files.')
+    parser.add_argument('-s', '--size', action='append', default=[], metavar='DELAYSxWAVELENGTHS',
+                        help='file size to generate (repeatable, default ' + ' '.join(BENCH_SIZES) + ')')
+    parser.add_argument('-n', '--slices', action='append', type=int, default=[],
+                        help='number of slices drawn (repeatable, default 1 10 100)')
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='calls per measurement, the median is reported')
+    parser.add_argument('-d', '--directory', help='keep the synthetic files here')
+    parser.add_argument('-o', '--output', default='bench.json')
+    args = parser.parse_args(argv)
+    sizes = []
+    for size in args.size or BENCH_SIZES:
+        delays, _, wavelengths = size.lower().partition('x')
+        try:
+            sizes.append((int(delays), int(wavelengths)))
+        except ValueError:
+            parser.error('size must look like 1000x700, not ' + repr(size))
+    directory = args.directory or tempfile.mkdtemp(prefix='bench-')
+    os.makedirs(directory, exist_ok=True)
+
+    results = []
+    try:
+        for delays, wavelengths in sizes:
+            filename = os.path.join(directory, 'synthetic_%dx%d.hdf5' % (delays, wavelengths))
+            if not os.path.exists(filename):
+                synthetic_ta(filename, delays, wavelengths)
+            result = bench_file(filename, args.slices or BENCH_SLICES, max(args.repeats, 1))
+            results.append(result)
+            print('%dx%d: open %.3f s cold, %.4f s warm; heatmap %s' % (
+                delays, wavelengths, result['import_cold_seconds'],
+                result['import_warm_seconds'], ', '.join(
+                    '%s %.3f s %.0f kB' % (name, ta['seconds'], ta['bytes'] / 1024)
+                    for name, ta in result['ta'].items())))
+            for graph in ('kinetics', 'spectra'):
+                for row in result[graph]:
+                    print('  %s x%d: %.4f s %.0f kB, add one %.4f s' % (
+                        graph, row['slices'], row['seconds'], row['bytes'] / 1024,
+                        row['add_one_seconds']))
+    finally:
+        if args.directory == None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(created=timer.strftime('%Y-%m-%dT%H:%M:%S'),
+                       python=sys.version.split()[0], numpy=np.__version__,
+                       dash=dash.__version__, cpus=os.cpu_count(),
+                       repeats=args.repeats, results=results), f, indent=1)
+    print('results -> ' + args.output)
+    return 0
+
+# Production server
+# Opens files and builds everything their first view needs (dtt, prefix sums,
+# heatmap pyramid), like an import job but in this process, and keeps them in
+# DATA. Returns the file dropdown options.
+def preload(files):
+    options = {}
+    for filename in files:
+        with timed('preload'):
+            import_data(options, filename, os.path.basename(filename))
+            data = DATA[filename]
+            data.dtt
+            for axis in (0, 1):
+                prefix_sums(data, axis)
+            get_pyramid(filename)
+    return options
+
+def serve_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='strankslab-data-analysis.py serve',
+        description='Run the dashboard on gunicorn with pre-forked workers.')
+    parser.add_argument('files', nargs='*',
+                        help='files to load before forking (default $STRANKSLAB_PRELOAD)')
+    parser.add_argument('-b', '--bind', default=SERVE_BIND)
+    parser.add_argument('-w', '--workers', type=int, default=SERVE_WORKERS)
+    parser.add_argument('--threads', type=int, default=1,
+                        help='threads per worker (default 1)')
+    args = parser.parse_args(argv)
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        parser.error('serve needs gunicorn (pip install gunicorn)')
+
+    imported = timer.perf_counter() - IMPORT_STARTED
+    start = timer.perf_counter()
+    trim_cache()
+    file_dropdown.options = overlay_dropdown.options = preload(args.files or PRELOAD_FILES)
+    preloaded = timer.perf_counter() - start
+    STARTUP_SECONDS.labels('import').set(imported)
+    STARTUP_SECONDS.labels('preload').set(preloaded)
+
+    def when_ready(server):
+        print('Serving on %s with %d workers: imported in %.2f s, %d files preloaded in %.2f s' % (
+            args.bind, args.workers, imported, len(file_dropdown.options), preloaded), flush=True)
+
+    def child_exit(server, worker):
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            multiprocess.mark_process_dead(worker.pid)
+
+    class Server(BaseApplication):
+        def load_config(self):
+            config = dict(bind=args.bind, workers=args.workers, threads=args.threads,
+                          timeout=SERVE_TIMEOUT, preload_app=True,
+                          when_ready=when_ready, child_exit=child_exit)
+            for key, value in config.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app.server
+
+    Server().run()
+    return 0
 
 if __name__ == "__main__":
-    app.run_server(debug=True, port=8888)
+    if sys.argv[1:2] == ['batch']:
+        sys.exit(batch_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['bench']:
+        sys.exit(bench_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['serve']:
+        sys.exit(serve_main(sys.argv[2:]))
+    trim_cache()
+    app.run(debug=True, port=8888)
     
     
\ No newline at end of file